@@ -1,25 +1,43 @@
-from pathlib import Path
 import torch
 import torch.utils.data
 import numpy as np
 import random
 from utils.utils import get_conditions
+from dataset.shards import SpectrogramView
 from settings import *
 
 
+def load_shortlist():
+    """Loads the filtered sample list as a sorted array. The sorted copy is cached next to the list and rebuilt
+    whenever the list is newer."""
+    source = FILTERED_SAMPLE_PATHS + '.npy'
+    cache = FILTERED_SAMPLE_PATHS + '_sorted.npy'
+    if not os.path.exists(cache) or os.path.getmtime(cache) < os.path.getmtime(source):
+        np.save(cache, np.unique(np.load(source)))
+    return np.load(cache)
+
+
+def is_shortlisted(paths, shortlist):
+    """Membership of every path in the sorted shortlist, by binary search."""
+    if len(shortlist) == 0:
+        return np.zeros(len(paths), dtype=bool)
+    positions = np.minimum(np.searchsorted(shortlist, paths), len(shortlist) - 1)
+    return shortlist[positions] == paths
+
+
 class UnetInput(torch.utils.data.Dataset):
-    def __init__(self, state):
-        self.SPECTROGRAM_DIRECTORY = os.path.join(MUSDB_SPLITS_PATH, state)
+    """U-Net samples. With remix the training samples are [mags, stem phases] pairs, which the trainer turns into
+    new mixtures with dataset.remix.remix_batch."""
+
+    def __init__(self, state, remix=REMIX):
+        self.view = SpectrogramView(state)
         self.L = len(SOURCES_SUBSET)
-        self.remove_source_ids = np.setdiff1d(np.arange(len(SOURCES)), SOURCES_SUBSET_ID)
+        self.remix = remix and state == 'train'
 
-        self.shortlisted = np.load(FILTERED_SAMPLE_PATHS + '.npy')
-        self.input_list = []
-        paths = list(Path(self.SPECTROGRAM_DIRECTORY).rglob("*.npy"))  ## Finds all the .npy files in the directory
-        for filepath in paths:
-            filepath_str = filepath.as_posix()
-            if (filepath_str in self.shortlisted) or state != 'train':
-                self.input_list.append(filepath_str)
+        if state == 'train':
+            self.input_list = list(np.flatnonzero(is_shortlisted(self.view.paths, load_shortlist())))
+        else:
+            self.input_list = list(range(len(self.view)))
 
         _ = random.shuffle(self.input_list)
 
@@ -27,26 +45,23 @@ class UnetInput(torch.utils.data.Dataset):
         return len(self.input_list)
 
     def __getitem__(self, idx):
-        sample = np.load(self.input_list[idx], allow_pickle=True).item()
-        mixture_phase = np.angle(sample['spec'][-1])
-        mags = np.absolute(np.nan_to_num(np.delete(sample['spec'], self.remove_source_ids, axis=0))) + np.finfo(
-            np.float).eps
-        true_label = np.delete(sample['true_label'], self.remove_source_ids, axis=0)
-        return torch.from_numpy(mags).float(), \
-               [torch.from_numpy(mixture_phase).unsqueeze(0), self.input_list[idx], torch.from_numpy(true_label)]
+        sample_id = self.input_list[idx]
+        mixture_phase = self.view.phase(sample_id)
+        mags = self.view.mag(sample_id)
+        true_label = self.view.true_label[sample_id].astype(np.int64)
+        inputs = torch.from_numpy(mags)
+        if self.remix:
+            inputs = [inputs, torch.from_numpy(self.view.stem_phase(sample_id))]
+        return inputs, \
+               [torch.from_numpy(mixture_phase), str(self.view.paths[sample_id]), torch.from_numpy(true_label)]
 
 
 class UnetInputUnfiltered(torch.utils.data.Dataset):
     def __init__(self, state):
-        self.SPECTROGRAM_DIRECTORY = os.path.join(MUSDB_SPLITS_PATH, state)
+        self.view = SpectrogramView(state)
         self.L = len(SOURCES_SUBSET)
-        self.remove_source_ids = np.setdiff1d(np.arange(len(SOURCES)), SOURCES_SUBSET_ID)
 
-        self.input_list = []
-        paths = list(Path(self.SPECTROGRAM_DIRECTORY).rglob("*.npy"))  ## Finds all the .npy files in the directory
-        for filepath in paths:
-            filepath_str = filepath.as_posix()
-            self.input_list.append(filepath_str)
+        self.input_list = list(range(len(self.view)))
 
         _ = random.shuffle(self.input_list)
 
@@ -54,30 +69,46 @@ class UnetInputUnfiltered(torch.utils.data.Dataset):
         return len(self.input_list)
 
     def __getitem__(self, idx):
-        sample = np.load(self.input_list[idx], allow_pickle=True).item()
-        mixture_phase = np.angle(sample['spec'][-1])
-        mags = np.absolute(np.nan_to_num(np.delete(sample['spec'], self.remove_source_ids, axis=0))) + np.finfo(
-            np.float).eps
-        true_label = np.delete(sample['true_label'], self.remove_source_ids, axis=0)
-        return torch.from_numpy(mags).float(), \
-               [torch.from_numpy(mixture_phase).unsqueeze(0), self.input_list[idx], torch.from_numpy(true_label)]
+        sample_id = self.input_list[idx]
+        mixture_phase = self.view.phase(sample_id)
+        mags = self.view.mag(sample_id)
+        true_label = self.view.true_label[sample_id].astype(np.int64)
+        return torch.from_numpy(mags), \
+               [torch.from_numpy(mixture_phase), str(self.view.paths[sample_id]), torch.from_numpy(true_label)]
 
 
 class CUnetInput(torch.utils.data.Dataset):
-    def __init__(self, state):
-        self.SPECTROGRAM_DIRECTORY = os.path.join(MUSDB_SPLITS_PATH, state)
+    """C-U-Net samples, one per (sample, condition) pair.
+
+    With grouped=True every item is the whole group of condition variants of a sample, built from a single read of
+    its spectrogram. Loaders must then be built with batch_size=self.loader_batch_size and
+    collate_fn=self.collate_fn, which flattens the groups into batches of the same layout as in the ungrouped mode.
+    Their content differs though: a batch holds BATCH_SIZE // n_conditions samples with all of their conditions
+    instead of independently drawn (sample, condition) pairs, which changes the BatchNorm statistics and the gradient
+    noise. Grouping is therefore opt-in (GROUPED_CONDITIONS).
+    """
+
+    def __init__(self, state, grouped=GROUPED_CONDITIONS):
+        self.view = SpectrogramView(state)
         self.L = len(SOURCES_SUBSET)
-        self.remove_source_ids = np.setdiff1d(np.arange(len(SOURCES)), SOURCES_SUBSET_ID)
-
-        conditions = get_conditions(self.L, state)
-        self.shortlisted = np.load(FILTERED_SAMPLE_PATHS + '.npy')
-        self.input_list = []
-        paths = list(Path(self.SPECTROGRAM_DIRECTORY).rglob("*.npy"))  ## Finds all the .npy files in the directory
-        for filepath in paths:
-            filepath_str = filepath.as_posix()
-            if (filepath_str in self.shortlisted) or state != 'train':
-                for condition in conditions:
-                    self.input_list.append([filepath_str, condition])
+        self.grouped = grouped
+
+        self.conditions = get_conditions(self.L, state)
+        if state == 'train':
+            sample_ids = np.flatnonzero(is_shortlisted(self.view.paths, load_shortlist()))
+        else:
+            sample_ids = range(len(self.view))
+        if self.grouped:
+            self.input_list = list(sample_ids)
+            self.loader_batch_size = max(1, BATCH_SIZE // len(self.conditions))
+            self.collate_fn = collate_condition_groups
+        else:
+            self.input_list = []
+            for sample_id in sample_ids:
+                for condition in self.conditions:
+                    self.input_list.append([sample_id, condition])
+            self.loader_batch_size = BATCH_SIZE
+            self.collate_fn = torch.utils.data.dataloader.default_collate
 
         _ = random.shuffle(self.input_list)
 
@@ -85,12 +116,16 @@ class CUnetInput(torch.utils.data.Dataset):
         return len(self.input_list)
 
     def __getitem__(self, idx):
-        file_name, condition = self.input_list[idx]
-        sample = np.load(file_name, allow_pickle=True).item()
-        mixture_phase = np.angle(sample['spec'][-1])
-        mags = np.absolute(np.nan_to_num(np.delete(sample['spec'], self.remove_source_ids, axis=0))) + np.finfo(
-            np.float).eps
-        true_label = np.delete(sample['true_label'], self.remove_source_ids, axis=0)
+        if self.grouped:
+            sample_id = self.input_list[idx]
+            mags, mixture_phase = self.view.mag(sample_id), self.view.phase(sample_id)
+            return [self.conditioned_sample(sample_id, mags, mixture_phase, condition) for condition in self.conditions]
+        sample_id, condition = self.input_list[idx]
+        return self.conditioned_sample(sample_id, self.view.mag(sample_id), self.view.phase(sample_id), condition)
+
+    def conditioned_sample(self, sample_id, mags, mixture_phase, condition):
+        file_name = str(self.view.paths[sample_id])
+        true_label = self.view.true_label[sample_id].astype(np.int64)
         if not condition.any():
             target = np.zeros(shape=[1, *mags.shape[1:]])  # + np.finfo(np.float).eps
         elif np.prod(condition) == 1:
@@ -100,4 +135,9 @@ class CUnetInput(torch.utils.data.Dataset):
             target = mags[selected_id][None]
         input_mix = np.concatenate([target, mags[-1][None]], axis=0)
         return [torch.from_numpy(input_mix).float(), torch.from_numpy(condition).float()], \
-               [torch.from_numpy(mixture_phase).unsqueeze(0), file_name, torch.from_numpy(true_label), torch.from_numpy(condition).float()]
+               [torch.from_numpy(mixture_phase), file_name, torch.from_numpy(true_label), torch.from_numpy(condition).float()]
+
+
+def collate_condition_groups(batch):
+    """Collates a batch of condition groups into a batch of their (sample, condition) items."""
+    return torch.utils.data.dataloader.default_collate([item for group in batch for item in group])
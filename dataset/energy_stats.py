@@ -0,0 +1,71 @@
+"""Energy statistics of the sources, which set the weights of the energy based losses.
+
+Preprocessing stores the signal energy of every chunk and source in the shards (energy.npy). They are gathered in a
+single pass into a table indexed by track, ENERGY_STATS_PATH, holding for every track of the train subset its number
+of chunks and the mean chunk energy of every source and of the mixture. The table is rebuilt whenever it is older
+than the preprocessing manifest. The energy of a source over the dataset is the mean over all the chunks, which is
+what the ACC_ENERGY, VOC_ENERGY, ... constants used to hold.
+"""
+
+import numpy as np
+import pandas as pd
+from dataset.shards import load_manifest, scan_shards, shard_path
+from settings import *
+
+COLUMNS = [*SOURCES, 'mixture']
+
+
+def chunk_energies(subset_type='train'):
+    """Track names [n] and energies [n, len(SOURCES) + 1] of all the chunks of a subset."""
+    manifest = load_manifest() if os.path.exists(PREPROCESSING_MANIFEST) else scan_shards()
+    if not manifest[subset_type]:
+        raise Exception('No {0} shards under {1}. Run preprocessing.py first'.format(subset_type, MUSDB_SHARDS_PATH))
+    tracks, energies = [], []
+    for track_name in sorted(manifest[subset_type]):
+        energy = np.load(os.path.join(shard_path(subset_type, track_name), 'energy.npy'))
+        tracks.append(np.full(len(energy), track_name))
+        energies.append(energy)
+    return np.concatenate(tracks), np.concatenate(energies)
+
+
+def build_energy_stats(subset_type='train'):
+    """Writes the table of the track-wise energy statistics and returns it."""
+    tracks, energies = chunk_energies(subset_type)
+    names, inverse, counts = np.unique(tracks, return_inverse=True, return_counts=True)
+    sums = np.zeros((len(names), energies.shape[1]))
+    np.add.at(sums, inverse, energies)
+    table = pd.DataFrame(sums / counts[:, None], index=pd.Index(names, name='track'), columns=COLUMNS)
+    table.insert(0, 'n_chunks', counts)
+    # Written to a temporary file first: distributed processes may rebuild the table concurrently
+    tmp_path = '{0}.{1}.tmp'.format(ENERGY_STATS_PATH, os.getpid())
+    table.to_csv(tmp_path)
+    os.replace(tmp_path, ENERGY_STATS_PATH)
+    return table
+
+
+def energy_stats_are_stale():
+    if not os.path.exists(ENERGY_STATS_PATH):
+        return True
+    return os.path.exists(PREPROCESSING_MANIFEST) and \
+           os.path.getmtime(ENERGY_STATS_PATH) < os.path.getmtime(PREPROCESSING_MANIFEST)
+
+
+def load_energy_stats():
+    """Track-wise energy statistics, rebuilt first if missing or stale."""
+    if energy_stats_are_stale():
+        print('Computing the energy statistics of the sources')
+        return build_energy_stats()
+    return pd.read_csv(ENERGY_STATS_PATH, index_col='track')
+
+
+def source_energies(sources=SOURCES_SUBSET):
+    """Mean chunk energy of every source over the train subset, as an array in the order of sources."""
+    table = load_energy_stats()
+    return np.array([(table[source] * table['n_chunks']).sum() / table['n_chunks'].sum() for source in sources])
+
+
+def spec_channel_weights(sources=SOURCES_SUBSET):
+    """Weights w_k of the spectrogram-channel U-Net losses, such that w_k * E_k is the same for every source and
+    the weights add up to 1."""
+    inverse = 1. / source_energies(sources)
+    return inverse / inverse.sum()
@@ -3,13 +3,15 @@ import sys
 
 sys.path.append('../')
 from functools import partial
+from multiprocessing import get_context
 import librosa
 import torch
 from utils.utils import create_folder
+from dataset.shards import write_track_shard, build_indexes, build_view, shard_path, load_manifest, SUBSETS
 import librosa.display
-from sklearn.model_selection import train_test_split
 import shutil
 import csv
+import json
 from settings import *
 
 
@@ -35,17 +37,23 @@ def split_sources(sources, flag):
     return splits
 
 
-def _stft(sources):
-    s = torch.from_numpy(sources).float().cuda(cuda)
+def get_device():
+    if PREPROCESSING_DEVICE != 'cpu' and torch.cuda.is_available():
+        return torch.device('cuda:{0}'.format(int(PREPROCESSING_DEVICE)))
+    return torch.device('cpu')
+
+
+def _stft(sources, device):
+    """STFT of all chunks of all stems of a track, computed in a single batched call on either a GPU or the CPU."""
+    s = torch.from_numpy(sources).float().to(device)
     shape = s.size()
     with torch.no_grad():
-        stft_output = torch.stft(s.view(-1, shape[-1]),
-                                 n_fft=NFFT,
-                                 hop_length=HOP_LENGTH,
-                                 window=torch.hann_window(NFFT).cuda(cuda))
-        stft = stft_output.view(*shape[:-1], *stft_output.size()[1:3], 2).data.cpu().numpy()
-    stft = stft[..., 0] + stft[..., 1] * 1j
-    return stft
+        stft = torch.stft(s.view(-1, shape[-1]),
+                          n_fft=NFFT,
+                          hop_length=HOP_LENGTH,
+                          window=torch.hann_window(NFFT, device=device),
+                          return_complex=True)
+    return stft.view(*shape[:-1], *stft.shape[1:]).cpu().numpy()
 
 
 def get_signal_energy(signal):
@@ -56,59 +64,117 @@ def save_chunks(chunk_id, subset_type, track_name, sources, energy_profile):
     save_folder_path = os.path.join(CHUNKS_PATH, subset_type, track_name, str(chunk_id))
     create_folder(save_folder_path)
     true_label = np.zeros(len(SOURCES) + 1, dtype='int')
+    energies = np.zeros(len(SOURCES) + 1)
     for source_id, source in enumerate([*SOURCES, 'MIX']):
         signal = sources[source_id, chunk_id]
         signal_energy = get_signal_energy(signal)
+        energies[source_id] = signal_energy
         if int(signal_energy) > ENERGY_THRESHOLD:
             true_label[source_id] = 1
         save_path = os.path.join(save_folder_path, source + '_' + str(int(round(signal_energy))) + '.wav')
-        energy_profile[source_id][os.path.dirname(save_path)] = signal_energy
+        energy_profile[source_id][os.path.dirname(save_path)] = float(signal_energy)
         librosa.output.write_wav(save_path, signal, TARGET_SAMPLING_RATE)
-    return energy_profile, true_label[:-1]
-
-
-VALIDATION_PATH = os.path.join(MUSDB_SPLITS_PATH, 'val')
-train_paths = []
-energy_profile = [{} for _ in range(len(SOURCES) + 1)]
-sample_dict = {}
-subset = ['train', 'test']
-cuda = 0
-
-for subset_type in subset:
-    DATA_PATH = os.path.join(MUSDB_WAVS_FOLDER_PATH, subset_type)
-    tracks = sorted(os.listdir(DATA_PATH))
-
-    for track_id, track_name in enumerate(tracks):
-        track_path = os.path.join(DATA_PATH, track_name)
-        dump_path = os.path.join(MUSDB_SPLITS_PATH, subset_type, track_name)
-        create_folder(dump_path)
-        sources_downsampled = get_sources(track_path)
-        sources_split = split_sources(sources_downsampled, subset_type)
-        stft_output = _stft(sources_split)
-        for chunk_id in range(stft_output.shape[1]):
-            matrix = stft_output[:, chunk_id, ...]
-            energy_profile, true_label = save_chunks(chunk_id, subset_type, track_name, sources_split, energy_profile)
-            if subset_type == 'train':
-                train_paths.append(os.path.join(dump_path, str(chunk_id) + '.npy'))
-            sample_dict['spec'] = matrix
-            sample_dict['true_label'] = true_label
-            full_path = os.path.join(dump_path, str(chunk_id))
-            np.save(full_path, sample_dict)
-            print('[{0}/{1}] || [{2}||{3}]'.format(chunk_id + 1, stft_output.shape[1], track_id + 1, len(tracks)))
-        del sources_split
-
-create_folder(ENERGY_PROFILE_FOLDER)
-for source_id, source in enumerate([*SOURCES, 'MIX']):
-    with open(os.path.join(ENERGY_PROFILE_FOLDER, source + '_energy_profile.csv'), 'w') as f:
-        w = csv.writer(f)
-        w.writerows(energy_profile[source_id].items())
-    np.save(os.path.join(ENERGY_PROFILE_FOLDER, source + '_energy_profile'), energy_profile[source_id])
-
-########## CREATING TRAINING-VALIDATION SPLIT##############
-X_train, X_val = train_test_split(train_paths, test_size=0.05, random_state=0)
-create_folder(VALIDATION_PATH)
-
-for file in X_val:
-    val_path = str.replace(file, 'train', 'val')
-    create_folder(os.path.abspath(os.path.join(val_path, os.pardir)))
-    shutil.move(file, val_path)
+    return energy_profile, true_label[:-1], energies
+
+
+def track_fingerprint(track_path):
+    """Size and modification time of every source WAV of a track. A track is reprocessed whenever this changes."""
+    fingerprint = {}
+    for element in [*SOURCES, 'mixture']:
+        stat = os.stat(os.path.join(track_path, element + '.wav'))
+        fingerprint[element] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprint
+
+
+def save_manifest(manifest):
+    # Written to a temporary file first so that an interrupted run never leaves a truncated manifest behind
+    tmp_path = PREPROCESSING_MANIFEST + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, PREPROCESSING_MANIFEST)
+
+
+def clear_track_outputs(subset_type, track_name):
+    for path in [shard_path(subset_type, track_name),
+                 os.path.join(CHUNKS_PATH, subset_type, track_name)]:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+
+def process_track(job):
+    """Downsamples, splits and transforms a single track. Runs inside a worker of the preprocessing pool.
+
+    Returns the manifest record of the track, holding the fingerprint of its source WAVs, the number of chunks
+    written and their energy profile.
+    """
+    subset_type, track_name, fingerprint = job
+    track_path = os.path.join(MUSDB_WAVS_FOLDER_PATH, subset_type, track_name)
+    clear_track_outputs(subset_type, track_name)
+
+    energy_profile = [{} for _ in range(len(SOURCES) + 1)]
+    true_labels, energies = [], []
+    sources_split = split_sources(get_sources(track_path), subset_type)
+    stft_output = _stft(sources_split, get_device())
+    for chunk_id in range(stft_output.shape[1]):
+        energy_profile, true_label, energy = save_chunks(chunk_id, subset_type, track_name, sources_split,
+                                                         energy_profile)
+        true_labels.append(true_label)
+        energies.append(energy)
+    write_track_shard(subset_type, track_name, stft_output, true_labels, energies)
+    return subset_type, track_name, {'fingerprint': fingerprint,
+                                     'n_chunks': int(stft_output.shape[1]),
+                                     'energy_profile': energy_profile}
+
+
+def init_worker():
+    # Splits the cores among the workers instead of letting every worker spawn one intra-op thread per core
+    torch.set_num_threads(max(1, os.cpu_count() // PREPROCESSING_WORKERS))
+
+
+def pending_jobs(manifest):
+    jobs = []
+    for subset_type in SUBSETS:
+        tracks = sorted(os.listdir(os.path.join(MUSDB_WAVS_FOLDER_PATH, subset_type)))
+        for track_name in tracks:
+            fingerprint = track_fingerprint(os.path.join(MUSDB_WAVS_FOLDER_PATH, subset_type, track_name))
+            record = manifest[subset_type].get(track_name)
+            if record is None or record['fingerprint'] != fingerprint:
+                jobs.append((subset_type, track_name, fingerprint))
+    return jobs
+
+
+def save_energy_profile(manifest):
+    create_folder(ENERGY_PROFILE_FOLDER)
+    for source_id, source in enumerate([*SOURCES, 'MIX']):
+        energy_profile = {}
+        for subset_type in SUBSETS:
+            for track_name in sorted(manifest[subset_type]):
+                energy_profile.update(manifest[subset_type][track_name]['energy_profile'][source_id])
+        with open(os.path.join(ENERGY_PROFILE_FOLDER, source + '_energy_profile.csv'), 'w') as f:
+            w = csv.writer(f)
+            w.writerows(energy_profile.items())
+        np.save(os.path.join(ENERGY_PROFILE_FOLDER, source + '_energy_profile'), energy_profile)
+
+
+def main():
+    create_folder(MUSDB_SHARDS_PATH)
+    manifest = load_manifest()
+    jobs = pending_jobs(manifest)
+    print('{0} tracks to process'.format(len(jobs)))
+
+    # spawn rather than fork: workers must not inherit the CUDA context of the parent
+    with get_context('spawn').Pool(PREPROCESSING_WORKERS, initializer=init_worker) as pool:
+        for done, (subset_type, track_name, record) in enumerate(pool.imap_unordered(process_track, jobs)):
+            manifest[subset_type][track_name] = record
+            save_manifest(manifest)
+            print('[{0}/{1}] [{2}] [TRACK NAME]: {3} || {4} chunks'.format(done + 1, len(jobs), subset_type,
+                                                                            track_name, record['n_chunks']))
+
+    save_energy_profile(manifest)
+    build_indexes(manifest)
+    for state in ['train', 'val', 'test']:
+        build_view(state)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""On-the-fly remixing of the training batches.
+
+With REMIX the training samples of UnetInput carry the phases of their stems. Every batch is then turned into new
+mixtures on the device of the model: each source is taken from a different, randomly drawn sample of the batch and
+scaled by a random gain in REMIX_GAINS. As the STFT is linear, the complex spectrum of the new mixture is the sum of
+the complex spectra of its stems, so its magnitude and phase come without going back to the waveforms.
+"""
+
+import numpy as np
+import torch
+from settings import *
+
+
+def remix_batch(inputs, visualization, gains=REMIX_GAINS):
+    """Remixes a batch of stems.
+
+    Args:
+        inputs: [mags, stem_phase], with mags [B, K + 1, F, T] the magnitudes of the stems and the mixture and
+            stem_phase [B, K, F, T] the phases of the stems, on the device of the model.
+        visualization: [mixture phase, sample paths, true labels] of the batch.
+
+    Returns:
+        The [B, K + 1, F, T] magnitudes of the new stems and mixtures, and the visualization of the batch with their
+        mixture phases and labels.
+    """
+    mags, stem_phase = inputs
+    B, K = stem_phase.shape[:2]
+    with torch.no_grad():
+        # An independent permutation of the batch per source, so that the stems of a mixture come from different chunks
+        perm = torch.argsort(torch.rand(B, K, device=mags.device), dim=0)
+        source_ids = torch.arange(K, device=mags.device)
+        gain = torch.empty(B, K, 1, 1, device=mags.device).uniform_(*gains)
+        stem_mags = mags[:, :-1][perm, source_ids].float() * gain
+        mixture = torch.polar(stem_mags, stem_phase[perm, source_ids].float()).sum(dim=1, keepdim=True)
+        mags = torch.cat([stem_mags, mixture.abs() + np.finfo(np.float64).eps], dim=1)
+    true_label = visualization[2].to(mags.device)[perm, source_ids]
+    return mags, [mixture.angle(), visualization[1], true_label, *visualization[3:]]
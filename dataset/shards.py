@@ -0,0 +1,259 @@
+"""Packed on-disk format of the spectrograms.
+
+Every track is stored as one shard folder MUSDB_SHARDS_PATH/<subset>/<track>/ holding
+    mag.npy:    [n_chunks, len(SOURCES) + 1, NFFT // 2 + 1, STFT_WIDTH] magnitudes (SHARD_DTYPE)
+    phase.npy:  [n_chunks, len(SOURCES) + 1, NFFT // 2 + 1, STFT_WIDTH] phases (SHARD_DTYPE)
+    label.npy:  [n_chunks, len(SOURCES)] true labels (int8)
+    energy.npy: [n_chunks, len(SOURCES) + 1] signal energies of the chunks (float64)
+The last channel is the mixture. Shards are read back through np.memmap so that a sample costs a single slice.
+
+Each split ('train', 'val', 'test') has an index <state>_index.npz, the manifest of the split, listing for every
+sample its id, track, chunk, shard, labels and energies. Sample ids keep the layout of the former per-chunk files,
+MUSDB_SPLITS_PATH/<state>/<track>/<chunk>.npy, so filtered sample lists and dump folders are unaffected. Indexes
+older than the preprocessing manifest are rebuilt on load.
+
+The datasets read from a view materialised for the current TYPE, MUSDB_SHARDS_PATH/views/<TYPE>/<state>/, which
+only holds what training consumes:
+    mag.npy:   [n_samples, K + 1, F, T] float32 magnitudes of the SOURCES_SUBSET stems and the mixture
+    phase.npy: [n_samples, 1, F, T] float32 mixture phase
+    stem_phase.npy: [n_samples, K, F, T] float32 phases of the SOURCES_SUBSET stems, only in the train view with
+               REMIX (training mixtures rebuilt from the stems, see dataset/remix.py)
+    index.npz: the index of the split in view order, with the labels restricted to the SOURCES_SUBSET stems
+"""
+
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+from sklearn.model_selection import train_test_split
+from utils.utils import create_folder
+from utils.distributed import get_rank, barrier
+from settings import *
+
+SUBSETS = ['train', 'test']
+
+def shard_path(subset_type, track_name):
+    return os.path.join(MUSDB_SHARDS_PATH, subset_type, track_name)
+
+
+def index_path(state):
+    return os.path.join(MUSDB_SHARDS_PATH, state + '_index.npz')
+
+
+def view_path(state):
+    return os.path.join(MUSDB_SHARDS_PATH, 'views', TYPE, state)
+
+
+def sample_path(state, track_name, chunk_id):
+    return os.path.join(MUSDB_SPLITS_PATH, state, track_name, str(chunk_id) + '.npy')
+
+
+def load_manifest():
+    if not os.path.exists(PREPROCESSING_MANIFEST):
+        return {subset_type: {} for subset_type in SUBSETS}
+    with open(PREPROCESSING_MANIFEST) as f:
+        return json.load(f)
+
+
+def write_track_shard(subset_type, track_name, spec, true_labels, energies):
+    """Writes the shard of a track.
+
+    Args:
+        spec: complex array [len(SOURCES) + 1, n_chunks, F, T] as returned by the STFT stage.
+        true_labels: int array [n_chunks, len(SOURCES)].
+        energies: float array [n_chunks, len(SOURCES) + 1].
+    """
+    path = shard_path(subset_type, track_name)
+    create_folder(path)
+    shape = (spec.shape[1], spec.shape[0], *spec.shape[2:])
+    mag = open_memmap(os.path.join(path, 'mag.npy'), mode='w+', dtype=SHARD_DTYPE, shape=shape)
+    phase = open_memmap(os.path.join(path, 'phase.npy'), mode='w+', dtype=SHARD_DTYPE, shape=shape)
+    for chunk_id in range(shape[0]):  # chunk by chunk to bound the temporaries
+        chunk = np.nan_to_num(spec[:, chunk_id])
+        mag[chunk_id] = np.absolute(chunk)
+        phase[chunk_id] = np.angle(chunk)
+    mag.flush()
+    phase.flush()
+    del mag, phase
+    np.save(os.path.join(path, 'energy.npy'), np.asarray(energies, dtype=np.float64))
+    np.save(os.path.join(path, 'label.npy'), np.asarray(true_labels, dtype=np.int8))
+
+
+def write_index(state, entries):
+    """Writes the index of a split from a list of (track_name, subset_type, chunk_id) entries."""
+    side_arrays = {}
+    paths, tracks, shards, rows, labels, energies = [], [], [], [], [], []
+    for track_name, subset_type, chunk_id in entries:
+        shard = os.path.join(subset_type, track_name)
+        if shard not in side_arrays:
+            side_arrays[shard] = (np.load(os.path.join(MUSDB_SHARDS_PATH, shard, 'label.npy')),
+                                  np.load(os.path.join(MUSDB_SHARDS_PATH, shard, 'energy.npy')))
+        paths.append(sample_path(state, track_name, chunk_id))
+        tracks.append(track_name)
+        shards.append(shard)
+        rows.append(chunk_id)
+        labels.append(side_arrays[shard][0][chunk_id])
+        energies.append(side_arrays[shard][1][chunk_id])
+    np.savez(index_path(state),
+             paths=np.array(paths, dtype=str),
+             tracks=np.array(tracks, dtype=str),
+             shards=np.array(shards, dtype=str),
+             rows=np.array(rows, dtype=np.int32),
+             true_label=np.array(labels, dtype=np.int8).reshape(-1, len(SOURCES)),
+             energy=np.array(energies, dtype=np.float64).reshape(-1, len(SOURCES) + 1))
+
+
+def build_indexes(manifest):
+    """Builds the train, val and test indexes from the preprocessing manifest. The validation samples are drawn
+    from the train subset with a fixed seed, so rebuilding the indexes always yields the same split."""
+    train_entries = []
+    for track_name in sorted(manifest['train']):
+        for chunk_id in range(manifest['train'][track_name]['n_chunks']):
+            train_entries.append((track_name, 'train', chunk_id))
+
+    ########## CREATING TRAINING-VALIDATION SPLIT##############
+    X_train, X_val = train_test_split(train_entries, test_size=0.05, random_state=0)
+    write_index('train', X_train)
+    write_index('val', X_val)
+
+    test_entries = []
+    for track_name in sorted(manifest['test']):
+        for chunk_id in range(manifest['test'][track_name]['n_chunks']):
+            test_entries.append((track_name, 'test', chunk_id))
+    write_index('test', test_entries)
+
+
+def scan_shards():
+    """Manifest-like listing of the shards found on disk, used when the preprocessing manifest is unavailable."""
+    manifest = {}
+    for subset_type in SUBSETS:
+        manifest[subset_type] = {}
+        subset_path = os.path.join(MUSDB_SHARDS_PATH, subset_type)
+        if not os.path.isdir(subset_path):
+            continue
+        for entry in os.scandir(subset_path):
+            label_path = os.path.join(entry.path, 'label.npy')
+            if entry.is_dir() and os.path.exists(label_path):
+                manifest[subset_type][entry.name] = {'n_chunks': len(np.load(label_path, mmap_mode='r'))}
+    return manifest
+
+
+def index_is_stale(state):
+    if not os.path.exists(index_path(state)):
+        return True
+    return os.path.exists(PREPROCESSING_MANIFEST) and \
+           os.path.getmtime(index_path(state)) < os.path.getmtime(PREPROCESSING_MANIFEST)
+
+
+def load_index(state):
+    """Loads the index of a split in a single read. A missing or stale index is rebuilt first, from the
+    preprocessing manifest if there is one and from a scan of the shard folders otherwise."""
+    if index_is_stale(state):
+        print('Rebuilding the split indexes')
+        build_indexes(load_manifest() if os.path.exists(PREPROCESSING_MANIFEST) else scan_shards())
+    with np.load(index_path(state)) as index:
+        return dict(index)
+
+
+class SpectrogramShards(object):
+    """Memory-mapped read access to the samples of a split."""
+
+    def __init__(self, state):
+        index = load_index(state)
+        self.paths = index['paths']
+        self.shards = index['shards']
+        self.rows = index['rows']
+        self.true_label = index['true_label']
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _open(self, shard, name):
+        # Opened lazily so that every DataLoader worker maps the files on its own
+        key = (shard, name)
+        if key not in self._maps:
+            self._maps[key] = np.load(os.path.join(MUSDB_SHARDS_PATH, shard, name + '.npy'), mmap_mode='r')
+        return self._maps[key]
+
+    def mag(self, idx):
+        return self._open(self.shards[idx], 'mag')[self.rows[idx]]
+
+    def phase(self, idx):
+        return self._open(self.shards[idx], 'phase')[self.rows[idx]]
+
+
+def build_view(state):
+    """Materialises the view of a split for the current TYPE. Magnitudes are stored exactly as the datasets used to
+    compute them on every access: absolute value of the selected stems plus machine epsilon, as float32."""
+    index = load_index(state)
+    shards = SpectrogramShards(state)
+    keep_ids = [*sorted(SOURCES_SUBSET_ID), len(SOURCES)]
+    path = view_path(state)
+    create_folder(path)
+    # Samples are written in shard order so that the source shards are read sequentially
+    order = np.lexsort((index['rows'], index['shards']))
+    shape = (len(order), len(keep_ids), NFFT // 2 + 1, STFT_WIDTH)
+    mag = open_memmap(os.path.join(path, 'mag.npy'), mode='w+', dtype=np.float32, shape=shape)
+    phase = open_memmap(os.path.join(path, 'phase.npy'), mode='w+', dtype=np.float32, shape=(shape[0], 1, *shape[2:]))
+    stem_phase = None
+    if REMIX and state == 'train':
+        stem_phase = open_memmap(os.path.join(path, 'stem_phase.npy'), mode='w+', dtype=np.float32,
+                                 shape=(shape[0], shape[1] - 1, *shape[2:]))
+    for i, sample_id in enumerate(order):
+        mag[i] = shards.mag(sample_id)[keep_ids].astype(np.float64) + np.finfo(np.float64).eps
+        sample_phase = shards.phase(sample_id)
+        phase[i] = sample_phase[-1:]
+        if stem_phase is not None:
+            stem_phase[i] = sample_phase[keep_ids[:-1]]
+    mag.flush()
+    phase.flush()
+    if stem_phase is not None:
+        stem_phase.flush()
+    del mag, phase, stem_phase
+    view_index = {name: array[order] for name, array in index.items()}
+    view_index['true_label'] = view_index['true_label'][:, sorted(SOURCES_SUBSET_ID)]
+    # Written last: its presence marks a complete view
+    np.savez(os.path.join(path, 'index.npz'), **view_index)
+
+
+def view_is_stale(state):
+    view_index = os.path.join(view_path(state), 'index.npz')
+    return index_is_stale(state) or not os.path.exists(view_index) or \
+           os.path.getmtime(view_index) < os.path.getmtime(index_path(state)) or \
+           (REMIX and state == 'train' and not os.path.exists(os.path.join(view_path(state), 'stem_phase.npy')))
+
+
+class SpectrogramView(object):
+    """Memory-mapped read access to the view of a split. The view is (re)built on first use if it is missing or
+    older than the index of the split. In distributed mode rank 0 alone rebuilds the index and the view, as writing
+    them truncates the files the other ranks would read, and every rank waits for it."""
+
+    def __init__(self, state):
+        if get_rank() == 0 and view_is_stale(state):
+            print('Building {0} view of the {1} split'.format(TYPE, state))
+            build_view(state)
+        barrier()
+        self.path = view_path(state)
+        with np.load(os.path.join(self.path, 'index.npz')) as index:
+            self.index = dict(index)
+        self.paths = self.index['paths']
+        self.true_label = self.index['true_label']
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _open(self, name):
+        if name not in self._maps:
+            # copy-on-write maps hand out writable arrays that torch.from_numpy can wrap without a copy
+            self._maps[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='c')
+        return self._maps[name]
+
+    def mag(self, idx):
+        return self._open('mag')[idx]
+
+    def phase(self, idx):
+        return self._open('phase')[idx]
+
+    def stem_phase(self, idx):
+        return self._open('stem_phase')[idx]
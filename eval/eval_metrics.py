@@ -2,36 +2,65 @@ import sys
 
 sys.path.append('../')
 from settings import *
+import json
+from multiprocessing import get_context
 import pandas as pd
 import numpy as np
 from utils.utils import create_folder
+from utils.bss_eval import bss_eval_framewise
 import librosa
-import mir_eval
+import soundfile as sf
 
 SAMPLING_RATE = TARGET_SAMPLING_RATE
-if ISOLATED:
-    TEST_UNET_CONFIG = TYPE+'_baseline'
-output_path = os.path.join(DUMPS_FOLDER, 'stitched', TEST_UNET_CONFIG, 'test')
-folders = os.listdir(output_path)
-
-metadata = ['filename', *[y + x for y in ['SDR_', 'SIR_', 'SAR_'] for x in SOURCES_SUBSET]]
-df = pd.DataFrame(columns=metadata)
-category = 'test'
-setting = TEST_UNET_CONFIG
-sr = TARGET_SAMPLING_RATE
+CATEGORY = 'test'
+SETTING = TYPE + '_baseline' if ISOLATED else TEST_UNET_CONFIG
 GT = os.path.join(MUSDB_WAVS_FOLDER_PATH + '_' + str(TARGET_SAMPLING_RATE))
-COMPARISON = os.path.join(DUMPS_FOLDER, 'stitched',
-                          TEST_UNET_CONFIG)  # [resampled_output_path,phasemixed_output_path,resampled_phasemixed_ouput_path]
-results_folder = os.path.join(DUMPS_FOLDER, 'results',
-                              setting)  # {1.ori:mixphased,resampled,resampled_mixphased; 2.down:mixphased_10800} ##TODO stereo
-create_folder(results_folder)
-
-folders = sorted(os.listdir(os.path.join(GT, category)))
-for i, folder in enumerate(folders):
-    print('[{0}/{1}] [TRACK NAME]: {2}'.format(i, len(folders), folder))
+GT_CACHE = GT + '_cache'  # decoded references, one float32 .npy per track and source
+COMPARISON = os.path.join(DUMPS_FOLDER, 'stitched', SETTING)
+RESULTS_FOLDER = os.path.join(DUMPS_FOLDER, 'results', SETTING)
+METADATA = ['filename', *[y + x for y in ['SDR_', 'SIR_', 'SAR_'] for x in SOURCES_SUBSET]]
+FRAME_METADATA = ['filename', 'window', *METADATA[1:]]
+
+
+def load_audio(path):
+    """Mono audio at SAMPLING_RATE. Files already at that rate are decoded directly, without going through the
+    resampler."""
+    if sf.info(path).samplerate == SAMPLING_RATE:
+        audio, _ = sf.read(path, dtype='float32', always_2d=True)
+        return audio.mean(axis=1)
+    return librosa.load(path, sr=SAMPLING_RATE)[0]
+
+
+def load_reference(folder, source):
+    """Ground truth of a source, decoded once and then read back from the cache, which is refreshed whenever the WAV
+    is newer."""
+    wav_path = os.path.join(GT, CATEGORY, folder, source + '.wav')
+    cache_path = os.path.join(GT_CACHE, CATEGORY, folder, source + '.npy')
+    if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(wav_path):
+        create_folder(os.path.dirname(cache_path))
+        tmp_path = cache_path[:-4] + '.tmp.npy'
+        np.save(tmp_path, load_audio(wav_path))
+        os.replace(tmp_path, cache_path)
+    return np.load(cache_path, mmap_mode='r')
+
+
+def estimate_fingerprint(folder):
+    """Size and modification time of every estimate of a track, along with the BSS-eval windows. A track is evaluated
+    again whenever this changes."""
+    fingerprint = {'windows': [EVAL_WINDOW, EVAL_HOP, EVAL_FILTER_LENGTH]}
+    for source in SOURCES_SUBSET:
+        stat = os.stat(os.path.join(COMPARISON, CATEGORY, folder, source + '.wav'))
+        fingerprint[source] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprint
+
+
+def evaluate_track(job):
+    """Framewise BSS-eval metrics of a track, with their medians over the windows (as reported by museval). Runs
+    inside a worker of the evaluation pool."""
+    folder, fingerprint = job
     for idx, source in enumerate(SOURCES_SUBSET):
-        gt_i, _ = librosa.load(os.path.join(GT, category, folder, source + '.wav'), sr=sr)
-        y_i, _ = librosa.load(os.path.join(COMPARISON, category, folder, source + '.wav'), sr=sr)
+        gt_i = load_reference(folder, source)
+        y_i = load_audio(os.path.join(COMPARISON, CATEGORY, folder, source + '.wav'))
 
         if idx == 0:
             L = len(gt_i)
@@ -39,16 +68,54 @@ for i, folder in enumerate(folders):
             y = np.zeros([len(SOURCES_SUBSET), L])
 
         gt[idx] = gt_i[:L]
-        del gt_i
-        y[idx] = y_i[:L]
-        del y_i
+        y[idx, :min(L, len(y_i))] = y_i[:L]
         # gt = gt[:,:y.shape[0]] ##Also measure the impact of this. notice that min and max value indices of gt and estimates do not always coincide (but are closeby)
 
-    (sdr, sir, sar, perm) = mir_eval.separation.bss_eval_sources(gt, y, compute_permutation=False)
-    row = [*sdr, *sir, *sar]
-    print('Perm : ' + str(perm))
-    del sdr, sar, sir, perm
-    df.loc[i] = [folder, *row]
-    del row
+    metrics, medians = bss_eval_framewise(gt, y)
+    return folder, {'fingerprint': fingerprint, 'row': medians.reshape(-1).tolist(),
+                    'frames': metrics.transpose(2, 0, 1).reshape(metrics.shape[2], -1).tolist()}
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_results(results, path):
+    # Written to a temporary file first so that an interrupted run never leaves truncated results behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(results, f)
+    os.replace(tmp_path, path)
+    df = pd.DataFrame([[folder, *results[folder]['row']] for folder in sorted(results)], columns=METADATA)
+    pd.DataFrame.to_csv(df, path_or_buf=os.path.join(RESULTS_FOLDER, CATEGORY + '_metrics.csv'), index=False)
+    df = pd.DataFrame([[folder, idx, *frame] for folder in sorted(results)
+                       for idx, frame in enumerate(results[folder]['frames'])], columns=FRAME_METADATA)
+    pd.DataFrame.to_csv(df, path_or_buf=os.path.join(RESULTS_FOLDER, CATEGORY + '_metrics_framewise.csv'), index=False)
+
+
+def main():
+    create_folder(RESULTS_FOLDER)
+    results_path = os.path.join(RESULTS_FOLDER, CATEGORY + '_metrics.json')
+    folders = sorted(os.listdir(os.path.join(GT, CATEGORY)))
+    results = {folder: record for folder, record in load_results(results_path).items() if folder in folders}
+
+    jobs = []
+    for folder in folders:
+        fingerprint = estimate_fingerprint(folder)
+        if folder not in results or results[folder]['fingerprint'] != fingerprint:
+            jobs.append((folder, fingerprint))
+    print('{0} of {1} tracks to evaluate'.format(len(jobs), len(folders)))
+
+    with get_context('spawn').Pool(EVAL_WORKERS) as pool:
+        for done, (folder, record) in enumerate(pool.imap_unordered(evaluate_track, jobs)):
+            results[folder] = record
+            save_results(results, results_path)
+            print('[{0}/{1}] [TRACK NAME]: {2}'.format(done + 1, len(jobs), folder))
+    save_results(results, results_path)
+
 
-pd.DataFrame.to_csv(df, path_or_buf=os.path.join(results_folder, category + '_metrics.csv'), index=False)
+if __name__ == '__main__':
+    main()
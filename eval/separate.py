@@ -0,0 +1,188 @@
+import sys
+
+sys.path.append('../')
+from collections import OrderedDict
+from itertools import chain
+import numpy as np
+import soundfile as sf
+import torch
+import torch.nn.functional as F
+from train.trainer import get_experiment, build_model
+from utils.utils import create_folder
+from settings import *
+
+
+class StreamingSeparator(object):
+    """Separates full-length tracks with a trained model, keeping memory bounded whatever the track length.
+
+    The mixture is read in blocks and turned into STFT frames as it arrives. The magnitudes are cut into windows of
+    STFT_WIDTH frames, SEPARATION_HOP frames apart, which go through the model SEPARATION_BATCH_SIZE at a time. The
+    estimated source magnitudes of overlapping windows are cross-faded with a hann taper (overlap-add in the spectral
+    domain) and, once no later window covers a frame, combined with the mixture phase and inverted by a streaming
+    overlap-add iSTFT. Frames are the ones torch.stft(center=True) computes over the whole track, whose ends are
+    reflect-padded as in the training spectrograms, so a model that returns the mixture reconstructs it exactly and
+    there are no seams between windows.
+    """
+
+    def __init__(self, model, device, window=STFT_WIDTH, hop=SEPARATION_HOP, batch_size=SEPARATION_BATCH_SIZE):
+        self.model = model.eval()
+        self.device = torch.device(device)
+        self.window = window
+        self.hop = hop
+        self.batch_size = batch_size
+        self.stft_window = torch.hann_window(NFFT, device=self.device)
+        # Floored so that the frames covered by a single window keep their estimate
+        self.taper = torch.hann_window(window, device=self.device).clamp_min(1e-3)
+
+    def stft_frames(self, blocks):
+        """STFT frames [F, n] of a stream of audio blocks, padded by reflecting NFFT // 2 samples on both ends."""
+        pad = NFFT // 2
+        carry = torch.zeros(0, device=self.device)
+        started = False
+        for block in chain(blocks, [None]):
+            if block is None:
+                if not started:
+                    raise Exception('Tracks must be longer than {0} samples'.format(pad))
+                # The carry always holds the last pad + 1 samples of the track, as NFFT - HOP_LENGTH > pad
+                signal = torch.cat([carry, carry[-pad - 1:-1].flip(0)])
+            else:
+                signal = torch.cat([carry, torch.as_tensor(block, dtype=torch.float32, device=self.device)])
+            if not started:
+                if len(signal) <= pad:
+                    carry = signal
+                    continue
+                signal = torch.cat([signal[1:pad + 1].flip(0), signal])
+                started = True
+            n = (len(signal) - NFFT) // HOP_LENGTH + 1
+            if n > 0:
+                yield torch.stft(signal[:(n - 1) * HOP_LENGTH + NFFT], n_fft=NFFT, hop_length=HOP_LENGTH,
+                                 window=self.stft_window, center=False, return_complex=True)
+                signal = signal[n * HOP_LENGTH:]
+            carry = signal
+
+    @torch.no_grad()
+    def separate_frames(self, frames):
+        """Estimated source spectra [C, F, n] for a stream of mixture frames [F, n], in frame order."""
+        n_bins = NFFT // 2 + 1
+        lead = self.window - self.hop  # silent frames ahead of the track, so that every frame is cross-faded
+        spec = torch.zeros(n_bins, lead, dtype=torch.complex64, device=self.device)
+        start = -lead  # frame of spec[:, 0], the first frame not emitted yet
+        acc = acc_weight = None  # cross-faded estimates of the frames from start on
+        next_window = -lead  # first frame of the next window
+        pending = []
+        n_frames = 0
+        for block in chain(frames, [None]):
+            final = block is None
+            if final:
+                # Pads the last windows with silence until every frame of the track has been covered
+                block = torch.zeros(n_bins, self.window, dtype=torch.complex64, device=self.device)
+            else:
+                n_frames += block.shape[1]
+            spec = torch.cat([spec, block], dim=1)
+            while next_window + self.window <= start + spec.shape[1] and not (final and next_window >= n_frames):
+                offset = next_window - start
+                pending.append((next_window, spec[:, offset:offset + self.window].abs() + np.finfo(np.float64).eps))
+                next_window += self.hop
+                if len(pending) < self.batch_size and not (final and next_window >= n_frames):
+                    continue
+                estimates = self.model.separate(torch.stack([mag for _, mag in pending]).unsqueeze(1))
+                if acc is None:
+                    acc = torch.zeros(estimates.shape[1], n_bins, 0, device=self.device)
+                    acc_weight = torch.zeros(0, device=self.device)
+                grow = pending[-1][0] + self.window - start - acc.shape[2]
+                acc = F.pad(acc, (0, grow))
+                acc_weight = F.pad(acc_weight, (0, grow))
+                for (first, _), estimate in zip(pending, estimates):
+                    acc[:, :, first - start:first - start + self.window] += estimate * self.taper
+                    acc_weight[first - start:first - start + self.window] += self.taper
+                pending = []
+                # No later window reaches the frames before next_window
+                done = min(next_window, n_frames) - start
+                keep = max(0, -start)  # the lead frames are not emitted
+                if done > keep:
+                    yield torch.polar(acc[:, :, keep:done] / acc_weight[keep:done], spec[:, keep:done].angle())
+                acc, acc_weight, spec = acc[:, :, done:], acc_weight[done:], spec[:, done:]
+                start += done
+
+    def istft_blocks(self, spectra, length):
+        """Streaming overlap-add inverse of torch.stft(center=True) for a stream of spectra [C, F, n]. Yields the
+        waveform blocks [C, n] of a signal of the given length."""
+        tail = tail_weight = None
+        skip = NFFT // 2
+        remaining = length
+        for spec in spectra:
+            n = spec.shape[-1]
+            frames = torch.fft.irfft(spec, n=NFFT, dim=1) * self.stft_window[:, None]
+            size = (n - 1) * HOP_LENGTH + NFFT
+            signal = F.fold(frames, (1, size), (1, NFFT), stride=(1, HOP_LENGTH)).view(spec.shape[0], size)
+            weight = F.fold((self.stft_window ** 2)[None, :, None].expand(1, NFFT, n), (1, size), (1, NFFT),
+                            stride=(1, HOP_LENGTH)).view(size)
+            if tail is not None:
+                signal[:, :tail.shape[1]] += tail
+                weight[:tail_weight.shape[0]] += tail_weight
+            complete = n * HOP_LENGTH  # the next frame starts there
+            block = signal[:, :complete] / torch.where(weight[:complete] > 1e-11, weight[:complete],
+                                                       torch.ones_like(weight[:complete]))
+            tail, tail_weight = signal[:, complete:], weight[complete:]
+            block = block[:, skip:skip + remaining]
+            skip = max(0, skip - complete)
+            remaining -= block.shape[1]
+            if block.shape[1]:
+                yield block.clamp(-1., 1.)
+        if tail is not None and remaining > 0:
+            block = tail / torch.where(tail_weight > 1e-11, tail_weight, torch.ones_like(tail_weight))
+            yield block[:, skip:skip + remaining].clamp(-1., 1.)
+
+    def separate(self, mixture_path, output_paths, block_size=HOP_LENGTH * STFT_WIDTH):
+        """Separates a mono mixture WAV sampled at TARGET_SAMPLING_RATE into one WAV per estimated source."""
+        info = sf.info(mixture_path)
+        if info.samplerate != TARGET_SAMPLING_RATE:
+            raise Exception('{0} is sampled at {1} Hz instead of {2} Hz'.format(mixture_path, info.samplerate,
+                                                                               TARGET_SAMPLING_RATE))
+        blocks = sf.blocks(mixture_path, blocksize=block_size, dtype='float32', always_2d=True)
+        frames = self.stft_frames(block.mean(axis=1) for block in blocks)
+        writers = [sf.SoundFile(path, 'w', TARGET_SAMPLING_RATE, 1, subtype='FLOAT') for path in output_paths]
+        try:
+            for block in self.istft_blocks(self.separate_frames(frames), info.frames):
+                block = block.cpu().numpy()
+                for writer, audio in zip(writers, block):
+                    writer.write(audio)
+        finally:
+            for writer in writers:
+                writer.close()
+
+
+def load_model(device):
+    experiment = get_experiment(EXPERIMENT)
+    model = build_model(experiment, device)
+    state_dict = torch.load(TEST_UNET_WEIGHTS_PATH, map_location=lambda storage, loc: storage)
+    if 'checkpoint' in TEST_UNET_WEIGHTS_PATH:
+        state_dict = state_dict['state_dict']
+    new_state_dict = OrderedDict()
+    for k, v in state_dict.items():
+        name = k.replace('model.', '')
+        new_state_dict[name] = v
+    model.model.load_state_dict(new_state_dict, strict=True)
+    return model.to(device)
+
+
+def main():
+    device = 'cuda:{0}'.format(MAIN_DEVICE) if torch.cuda.is_available() else 'cpu'
+    separator = StreamingSeparator(load_model(device), device)
+    mixtures_path = os.path.join(MUSDB_WAVS_FOLDER_PATH + '_' + str(TARGET_SAMPLING_RATE), 'test')
+    output_path = os.path.join(DUMPS_FOLDER, 'stitched', TEST_UNET_CONFIG, 'test')
+    if ISOLATED:
+        elements = [SOURCES_SUBSET[ISOLATED_SOURCE_ID]]
+        output_path = os.path.join(DUMPS_FOLDER, 'stitched', TYPE + '_baseline', 'test')
+    else:
+        elements = SOURCES_SUBSET
+    folders = sorted(os.listdir(mixtures_path))
+    for idx, folder in enumerate(folders):
+        print('Separating [{0}/{1}] [TRACK NAME]: {2}'.format(idx, len(folders), folder))
+        create_folder(os.path.join(output_path, folder))
+        separator.separate(os.path.join(mixtures_path, folder, 'mixture.wav'),
+                           [os.path.join(output_path, folder, element + '.wav') for element in elements])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,61 @@
 import torch
-import torch.nn.functional as F
+from dataset.energy_stats import source_energies, spec_channel_weights
 from settings import *
 
 
+def source_l1(pred, gt):
+    """L1 losses [K] of the K sources of pred and gt [B, K, ...], computed by a single reduction."""
+    return (pred - gt).abs().mean(dim=[0, *range(2, pred.dim())])
+
+
+def energy_weights(power=1):
+    """Weights (E_ref / E_k) ** power of the energy based losses, E_ref being the energy of the most energetic
+    source, whose weight is thus 1."""
+    energies = torch.from_numpy(source_energies())
+    return ((energies.max() / energies) ** power).float()
+
+
+def finite_differences(x):
+    """Differences along the last two axes of x [..., H, W], [..., H, W - 1] and [..., H - 1, W]. They are the
+    image gradients of tf.image.image_gradients without their zero last column and row."""
+    return x[..., 1:] - x[..., :-1], x[..., 1:, :] - x[..., :-1, :]
+
+
+class GradientDifferenceLoss(torch.autograd.Function):
+    """mean(|dx(gen) - dx(gt)| ** alpha + |dy(gen) - dy(gt)| ** alpha), with the mean over the B x C x H x W
+    positions. The differences are linear, so they are taken on gen - gt. Nothing is saved for backward but the
+    inputs, and backward recomputes the differences, so every temporary is released as soon as it is reduced."""
+
+    @staticmethod
+    def forward(ctx, gen_frames, gt_frames, alpha):
+        ctx.save_for_backward(gen_frames, gt_frames)
+        ctx.alpha = alpha
+        total = 0
+        for d in finite_differences(gen_frames - gt_frames):
+            d = d.abs_()
+            total = total + (d.sum() if alpha == 1 else d.pow_(alpha).sum())
+        return total / gen_frames.numel()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        gen_frames, gt_frames = ctx.saved_tensors
+        scale = grad_output / gen_frames.numel()
+        grad = torch.zeros_like(gen_frames)
+        for axis, d in zip([-1, -2], finite_differences(gen_frames - gt_frames)):
+            # d|u| ** alpha / du = alpha * |u| ** (alpha - 1) * sign(u), 0 where u is 0
+            g = d.sign() if ctx.alpha == 1 else ctx.alpha * d.abs().pow(ctx.alpha - 1) * d.sign()
+            g = g.mul_(scale)
+            n = d.shape[axis]
+            grad.narrow(axis, 1, n).add_(g)
+            grad.narrow(axis, 0, n).sub_(g)
+        grad_gt = -grad if ctx.needs_input_grad[1] else None
+        return grad if ctx.needs_input_grad[0] else None, grad_gt, None
+
+
 def gradient_loss(gen_frames, gt_frames, alpha=1):
-    def gradient(x):
-        # idea from tf.image.image_gradients(image)
-        # https://github.com/tensorflow/tensorflow/blob/r2.1/tensorflow/python/ops/image_ops_impl.py#L3441-L3512
-        # x: (b,c,h,w), float32 or float64
-        # dx, dy: (b,c,h,w)
-
-        h_x = x.size()[-2]
-        w_x = x.size()[-1]
-        # gradient step=1
-        left = x
-        right = F.pad(x, [0, 1, 0, 0])[:, :, :, 1:]
-        top = x
-        bottom = F.pad(x, [0, 0, 0, 1])[:, :, 1:, :]
-
-        # dx, dy = torch.abs(right - left), torch.abs(bottom - top)
-        dx, dy = right - left, bottom - top
-        # dx will always have zeros in the last column, right-left
-        # dy will always have zeros in the last row,    bottom-top
-        dx[:, :, :, -1] = 0
-        dy[:, :, -1, :] = 0
-
-        return dx, dy
-
-    # gradient
-    gen_dx, gen_dy = gradient(gen_frames)
-    gt_dx, gt_dy = gradient(gt_frames)
-    #
-    grad_diff_x = torch.abs(gt_dx - gen_dx)
-    grad_diff_y = torch.abs(gt_dy - gen_dy)
-
-    # condense into one tensor and avg
-    return torch.mean(grad_diff_x ** alpha + grad_diff_y ** alpha)
+    # Gradient difference loss, idea from tf.image.image_gradients(image)
+    # https://github.com/tensorflow/tensorflow/blob/r2.1/tensorflow/python/ops/image_ops_impl.py#L3441-L3512
+    return GradientDifferenceLoss.apply(gen_frames, gt_frames, alpha)
 
 
 class CUNetLoss(torch.nn.Module):
@@ -50,35 +70,48 @@ class CUNetLoss(torch.nn.Module):
         return loss
 
 
-class GradientLoss(torch.nn.Module):
-    def __init__(self, main_device, power=1):
-        super(GradientLoss, self).__init__()
+class WeightedSourceLoss(torch.nn.Module):
+    """Per-source L1 losses and their weighted sum, [l1, ..., lK, w1 * l1 + ... + wK * lK]. With weights=None it
+    returns the per-source losses alone, to be combined by a task weighting strategy.
+
+    Args:
+        weights: K weights of the sum, or None.
+        target: 'mags' compares the estimated and ground truth magnitudes, 'masks' the masks.
+    """
+
+    def __init__(self, main_device, weights=None, target='mags'):
+        super(WeightedSourceLoss, self).__init__()
         self.main_device = main_device
-        self.L1Loss = torch.nn.L1Loss().to(main_device)
-        self.power = power
+        self.target = target
+        self.weights = None if weights is None else torch.as_tensor(weights, dtype=torch.float32)
+
+    def components(self, x):
+        gt_mags_sq, pred_mags_sq, _, _, gt_masks, pred_masks = x
+        if self.target == 'masks':
+            return source_l1(pred_masks, gt_masks)
+        return source_l1(pred_mags_sq, gt_mags_sq)
+
+    def batch_weights(self, x, losses):
+        if self.weights.device != losses.device:
+            self.weights = self.weights.to(losses.device)
+        return self.weights
 
     def forward(self, x):
-        gt_mags_sq, pred_mags_sq, gt_mags, _, _, _ = x
+        losses = self.components(x)
+        if self.weights is None:
+            return list(losses.unbind())
+        return [*losses.unbind(), (self.batch_weights(x, losses) * losses).sum()]
+
+
+class GradientLoss(WeightedSourceLoss):
+    def __init__(self, main_device, power=1):
+        super(GradientLoss, self).__init__(main_device, energy_weights(power))
+
+    def forward(self, x):
+        gt_mags_sq, pred_mags_sq, _, _, _, _ = x
         lg = gradient_loss(pred_mags_sq, gt_mags_sq)
-        if K == 2:
-            l1 = self.L1Loss(pred_mags_sq[:, 0], gt_mags_sq[:, 0])
-            w1 = (ACC_ENERGY / VOC_ENERGY) ** self.power
-            l2 = self.L1Loss(pred_mags_sq[:, 1], gt_mags_sq[:, 1])
-            w2 = 1
-            l11 = w1 * l1 + w2 * l2 + lg
-            return [l1, l2, lg, l11]
-        else:
-            l1 = self.L1Loss(pred_mags_sq[:, 0], gt_mags_sq[:, 0])
-            w1 = (BAS_ENERGY / VOC_ENERGY) ** self.power
-            l2 = self.L1Loss(pred_mags_sq[:, 1], gt_mags_sq[:, 1])
-            w2 = (BAS_ENERGY / DRU_ENERGY) ** self.power
-            l11 = w1 * l1 + w2 * l2
-            l3 = self.L1Loss(pred_mags_sq[:, 2], gt_mags_sq[:, 2])
-            w3 = 1
-            l4 = self.L1Loss(pred_mags_sq[:, 3], gt_mags_sq[:, 3])
-            w4 = (BAS_ENERGY / OTH_ENERGY) ** self.power
-            l22 = w3 * l3 + w4 * l4
-            return [l1, l2, l3, l4, lg, l11 + l22 + lg]
+        losses = self.components(x)
+        return [*losses.unbind(), lg, (self.batch_weights(x, losses) * losses).sum() + lg]
 
 
 class SingleSourceDirectLoss(torch.nn.Module):
@@ -93,142 +126,41 @@ class SingleSourceDirectLoss(torch.nn.Module):
         return loss
 
 
-class IndividualLosses(torch.nn.Module):
+class IndividualLosses(WeightedSourceLoss):
     def __init__(self, main_device):
-        super(IndividualLosses, self).__init__()
-        self.main_device = main_device
-        self.L1Loss = torch.nn.L1Loss().to(main_device)
-
-    def forward(self, x):
-        gt_mags_sq, pred_mags_sq, _, _, _, _ = x
-        l1 = self.L1Loss(pred_mags_sq[:, 0], gt_mags_sq[:, 0])
-        l2 = self.L1Loss(pred_mags_sq[:, 1], gt_mags_sq[:, 1])
-        if K == 4:
-            l3 = self.L1Loss(pred_mags_sq[:, 2], gt_mags_sq[:, 2])
-            l4 = self.L1Loss(pred_mags_sq[:, 3], gt_mags_sq[:, 3])
-            return [l1, l2, l3, l4]
-        return [l1, l2]
+        super(IndividualLosses, self).__init__(main_device)
 
 
-class UnitWeightedLoss(torch.nn.Module):
+class UnitWeightedLoss(WeightedSourceLoss):
     def __init__(self, main_device):
-        super(UnitWeightedLoss, self).__init__()
-        self.main_device = main_device
-        self.L1Loss = torch.nn.L1Loss().to(main_device)
-
-    def forward(self, x):
-        gt_mags_sq, pred_mags_sq, _, _, _, _ = x
-        l1 = self.L1Loss(pred_mags_sq[:, 0], gt_mags_sq[:, 0])
-        l2 = self.L1Loss(pred_mags_sq[:, 1], gt_mags_sq[:, 1])
-        if K == 4:
-            l3 = self.L1Loss(pred_mags_sq[:, 2], gt_mags_sq[:, 2])
-            l4 = self.L1Loss(pred_mags_sq[:, 3], gt_mags_sq[:, 3])
-            return [l1, l2, l3, l4, l1+l2+l3+l4]
-        return [l1, l2, l1+l2]
+        super(UnitWeightedLoss, self).__init__(main_device, torch.ones(K))
 
 
-class SpecChannelUnetLoss(torch.nn.Module):
+class SpecChannelUnetLoss(WeightedSourceLoss):
     def __init__(self, main_device):
-        super(SpecChannelUnetLoss, self).__init__()
-        self.main_device = main_device
-        self.L1Loss = torch.nn.L1Loss().to(main_device)
-
-    def forward(self, x):
-        gt_mags_sq, pred_mags_sq, _, _, _, _ = x
-        l1 = self.L1Loss(pred_mags_sq[:, 0], gt_mags_sq[:, 0])
-        l2 = self.L1Loss(pred_mags_sq[:, 1], gt_mags_sq[:, 1])
-        if K == 4:
-            l3 = self.L1Loss(pred_mags_sq[:, 2], gt_mags_sq[:, 2])
-            l4 = self.L1Loss(pred_mags_sq[:, 3], gt_mags_sq[:, 3])
-            return [l1, l2, l3, l4, w_1*l1+w_2*l2+w_3*l3+w_4*l4]
-        return [l1, l2, w_1*l1+w_2*l2]
+        super(SpecChannelUnetLoss, self).__init__(main_device, spec_channel_weights())
 
 
-class EnergyBasedLossPowerP(torch.nn.Module):
+class EnergyBasedLossPowerP(WeightedSourceLoss):
     def __init__(self, main_device, power=1):
-        super(EnergyBasedLossPowerP, self).__init__()
-        self.main_device = main_device
-        self.L1Loss = torch.nn.L1Loss().to(main_device)
-        self.power = power
+        super(EnergyBasedLossPowerP, self).__init__(main_device, energy_weights(power))
 
-    def forward(self, x):
-        gt_mags_sq, pred_mags_sq, gt_mags, _, _, _ = x
-        if K == 2:
-            l1 = self.L1Loss(pred_mags_sq[:, 0], gt_mags_sq[:, 0])
-            w1 = (ACC_ENERGY / VOC_ENERGY) ** self.power
-            l2 = self.L1Loss(pred_mags_sq[:, 1], gt_mags_sq[:, 1])
-            w2 = 1
-            l11 = w1 * l1 + w2 * l2
-            return [l1, l2, l11]
-        else:
-            l1 = self.L1Loss(pred_mags_sq[:, 0], gt_mags_sq[:, 0])
-            w1 = (BAS_ENERGY / VOC_ENERGY) ** self.power
-            l2 = self.L1Loss(pred_mags_sq[:, 1], gt_mags_sq[:, 1])
-            w2 = (BAS_ENERGY / DRU_ENERGY) ** self.power
-            l11 = w1 * l1 + w2 * l2
-            l3 = self.L1Loss(pred_mags_sq[:, 2], gt_mags_sq[:, 2])
-            w3 = 1
-            l4 = self.L1Loss(pred_mags_sq[:, 3], gt_mags_sq[:, 3])
-            w4 = (BAS_ENERGY / OTH_ENERGY) ** self.power
-            l22 = w3 * l3 + w4 * l4
-            return [l1, l2, l3, l4, l11 + l22]
-
-
-class EnergyBasedLossPowerPMask(torch.nn.Module):
+
+class EnergyBasedLossPowerPMask(WeightedSourceLoss):
     def __init__(self, main_device, power=1):
-        super(EnergyBasedLossPowerPMask, self).__init__()
-        self.main_device = main_device
-        self.L1Loss = torch.nn.L1Loss().to(main_device)
-        self.power = power
+        super(EnergyBasedLossPowerPMask, self).__init__(main_device, energy_weights(power), target='masks')
+
+
+class EnergyBasedLossInstantwise(WeightedSourceLoss):
+    """Energy based loss whose weights are the energy ratios of the ground truth of the batch, with the most
+    energetic source of the dataset as reference."""
 
-    def forward(self, x):
-        _, _, _, _, gt_masks, pred_masks = x
-        if K == 2:
-            l1 = self.L1Loss(pred_masks[:, 0], gt_masks[:, 0])
-            w1 = (ACC_ENERGY / VOC_ENERGY)**self.power
-            l2 = self.L1Loss(pred_masks[:, 1], gt_masks[:, 1])
-            w2 = 1
-            l11 = w1 * l1 + w2 * l2
-            return [l1, l2, l11]
-        else:
-            l1 = self.L1Loss(pred_masks[:, 0], gt_masks[:, 0])
-            w1 = (BAS_ENERGY / VOC_ENERGY)**self.power
-            l2 = self.L1Loss(pred_masks[:, 1], gt_masks[:, 1])
-            w2 = (BAS_ENERGY / DRU_ENERGY)**self.power
-            l11 = w1 * l1 + w2 * l2
-            l3 = self.L1Loss(pred_masks[:, 2], gt_masks[:, 2])
-            w3 = 1
-            l4 = self.L1Loss(pred_masks[:, 3], gt_masks[:, 3])
-            w4 = (BAS_ENERGY / OTH_ENERGY)**self.power
-            l22 = w3 * l3 + w4 * l4
-            return [l1, l2, l3, l4, l11 + l22]
-
-
-class EnergyBasedLossInstantwise(torch.nn.Module):
     def __init__(self, main_device, power=1):
-        super(EnergyBasedLossInstantwise, self).__init__()
-        self.main_device = main_device
-        self.L1Loss = torch.nn.L1Loss().to(main_device)
+        super(EnergyBasedLossInstantwise, self).__init__(main_device, energy_weights(power))
         self.power = power
+        self.reference = int(torch.argmin(self.weights))
 
-    def forward(self, x):
-        gt_mags_sq, pred_mags_sq, gt_mags, _, _, _ = x
-        if K == 2:
-            l1 = self.L1Loss(pred_mags_sq[:, 0], gt_mags_sq[:, 0])
-            w1 = pow(gt_mags[:, 1].pow(2).sum()/gt_mags[:, 0].pow(2).sum(), self.power)
-            l2 = self.L1Loss(pred_mags_sq[:, 1], gt_mags_sq[:, 1])
-            w2 = 1
-            l11 = w1 * l1 + w2 * l2
-            return [l1, l2, l11]
-        else:
-            l1 = self.L1Loss(pred_mags_sq[:, 0], gt_mags_sq[:, 0])
-            w1 = pow(gt_mags[:, 2].pow(2).sum()/gt_mags[:, 0].pow(2).sum(), self.power)
-            l2 = self.L1Loss(pred_mags_sq[:, 1], gt_mags_sq[:, 1])
-            w2 = pow(gt_mags[:, 2].pow(2).sum()/gt_mags[:, 1].pow(2).sum(), self.power)
-            l11 = w1 * l1 + w2 * l2
-            l3 = self.L1Loss(pred_mags_sq[:, 2], gt_mags_sq[:, 2])
-            w3 = 1
-            l4 = self.L1Loss(pred_mags_sq[:, 3], gt_mags_sq[:, 3])
-            w4 = pow(gt_mags[:, 2].pow(2).sum()/gt_mags[:, 3].pow(2).sum(), self.power)
-            l22 = w3 * l3 + w4 * l4
-            return [l1, l2, l3, l4, l11 + l22]
+    def batch_weights(self, x, losses):
+        gt_mags = x[2]
+        energies = gt_mags.pow(2).sum(dim=[0, *range(2, gt_mags.dim())])
+        return (energies[self.reference] / energies) ** self.power
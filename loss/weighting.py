@@ -0,0 +1,187 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+from utils.distributed import all_reduce_sum
+from settings import *
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def reduce_mean(tensor):
+    """Mean of a tensor over the processes in distributed mode. The reduction stays on the device."""
+    if is_distributed():
+        dist.all_reduce(tensor)
+        tensor /= dist.get_world_size()
+    return tensor
+
+
+def shared_parameters(model):
+    """Parameters of the last layer shared by all the sources: the top decoder block of the U-Net, which feeds the
+    final 1x1 convolution producing one channel per source."""
+    model = getattr(model, 'module', model)
+    return list(model.model.decoder[-1].parameters())
+
+
+class TaskWeighting(object):
+    """Base of the task weighting strategies, which combine the per-source losses [l1, ..., lK] of an iteration into
+    the training loss.
+
+    The weights and the running sums of the training losses of an epoch stay on the device of the model, so that
+    iterations never wait for the host. The sums are read back, and summed over the processes in distributed mode,
+    once per epoch in end_epoch, which leaves the average training losses of the epoch in avg_cost[epoch]. Epochs
+    without any training iteration on any process have no average.
+
+    state_dict() holds what a resumed run needs to carry on: the weights, the last epoch averages and the learnt
+    state of the strategy.
+    """
+
+    def __init__(self, model=None, k=K):
+        self.K = k
+        self.lambda_weight = torch.ones(k)
+        self.avg_cost = {}
+        self.running_cost = None
+        self.n_iterations = 0
+
+    def weights(self, device):
+        if self.lambda_weight.device != torch.device(device):
+            self.lambda_weight = self.lambda_weight.to(device)
+        return self.lambda_weight
+
+    def start_epoch(self, epoch):
+        self.running_cost = None
+        self.n_iterations = 0
+
+    def __call__(self, component_losses, epoch):
+        losses = torch.stack(component_losses)
+        return (self.weights(losses.device) * losses).sum()
+
+    def observe(self, component_losses, epoch):
+        """Accumulates the training losses of an iteration, after its backward pass."""
+        costs = torch.stack(component_losses).detach().double()
+        self.running_cost = costs if self.running_cost is None else self.running_cost + costs
+        self.n_iterations += 1
+
+    def end_epoch(self, epoch, device='cpu'):
+        # A process without training iterations still takes part in the reduction, with zeros
+        running_cost = [0.] * self.K if self.running_cost is None else self.running_cost.tolist()
+        totals = [*running_cost, self.n_iterations]
+        if is_distributed():
+            totals = all_reduce_sum(totals, device)
+        if totals[-1] > 0:
+            self.avg_cost[epoch] = np.array(totals[:-1]) / totals[-1]
+        # Only the two last epochs are ever needed
+        self.avg_cost = {e: cost for e, cost in self.avg_cost.items() if e >= epoch - 1}
+
+    def state_dict(self):
+        return {'lambda_weight': self.lambda_weight.cpu(),
+                'avg_cost': {e: cost.tolist() for e, cost in self.avg_cost.items()}}
+
+    def load_state_dict(self, state):
+        self.lambda_weight = state['lambda_weight'].clone()
+        self.avg_cost = {e: np.array(cost) for e, cost in state['avg_cost'].items()}
+
+    def log(self, writer, epoch):
+        for src, weight in zip(SOURCES_SUBSET, self.lambda_weight.tolist()):
+            writer.add_scalars('weights', {'W_' + src: weight}, epoch)
+        if epoch in self.avg_cost:
+            print('Epoch: {:04d} | TRAIN: {}'.format(epoch, ' '.join('{:.4f}'.format(c) for c in self.avg_cost[epoch])))
+
+
+class DynamicWeightAverage(TaskWeighting):
+    """Dynamic Weight Average (Liu et al., 2019). The weight of each task for an epoch is a softmax, scaled to sum
+    to K, of the ratio between its average training loss over the two previous epochs. The weights are 1 until two
+    epochs have been trained."""
+
+    def __init__(self, model=None, k=K, temperature=DWA_TEMP):
+        super(DynamicWeightAverage, self).__init__(model, k)
+        self.T = temperature
+
+    def start_epoch(self, epoch):
+        super(DynamicWeightAverage, self).start_epoch(epoch)
+        if epoch - 1 in self.avg_cost and epoch - 2 in self.avg_cost:
+            w = self.avg_cost[epoch - 1] / self.avg_cost[epoch - 2]
+            self.lambda_weight = torch.from_numpy(self.K * np.exp(w / self.T) / np.sum(np.exp(w / self.T))).float()
+        else:
+            self.lambda_weight = torch.ones(self.K)
+
+
+class UncertaintyWeighting(TaskWeighting):
+    """Homoscedastic uncertainty weighting (Kendall et al., 2018). Every task has a learnt log variance s_k and the
+    loss is sum_k exp(-s_k) * l_k + s_k. After every iteration the log variances take an SGD step of rate
+    UNCERTAINTY_LR along their gradient, 1 - exp(-s_k) * l_k, averaged over the processes in distributed mode."""
+
+    def __init__(self, model=None, k=K, lr=UNCERTAINTY_LR):
+        super(UncertaintyWeighting, self).__init__(model, k)
+        self.lr = lr
+        self.log_var = torch.zeros(k)
+
+    def __call__(self, component_losses, epoch):
+        losses = torch.stack(component_losses)
+        self.log_var = self.log_var.to(losses.device)
+        self.lambda_weight = torch.exp(-self.log_var)
+        return (self.lambda_weight * losses + self.log_var).sum()
+
+    def observe(self, component_losses, epoch):
+        super(UncertaintyWeighting, self).observe(component_losses, epoch)
+        costs = torch.stack(component_losses).detach().float()
+        self.log_var -= self.lr * reduce_mean(1 - torch.exp(-self.log_var) * costs)
+
+    def state_dict(self):
+        return dict(super(UncertaintyWeighting, self).state_dict(), log_var=self.log_var.cpu())
+
+    def load_state_dict(self, state):
+        super(UncertaintyWeighting, self).load_state_dict(state)
+        self.log_var = state['log_var'].clone()
+
+
+class GradNorm(TaskWeighting):
+    """GradNorm (Chen et al., 2018). The weights w_k, which add up to K, are learnt so that the gradient norms of the
+    weighted losses on the last shared layer, G_k = w_k * ||grad l_k||, approach mean(G) * r_k ** alpha, with r_k the
+    training rate l_k / l_k(0) of task k relative to the mean rate. The norms are taken during the forward pass of
+    every training iteration and the weights take an SGD step of rate GRADNORM_LR on sum_k |G_k - target_k| once the
+    iteration is observed."""
+
+    def __init__(self, model=None, k=K, alpha=GRADNORM_ALPHA, lr=GRADNORM_LR):
+        super(GradNorm, self).__init__(model, k)
+        self.shared_parameters = shared_parameters(model)
+        self.alpha = alpha
+        self.lr = lr
+        self.initial_cost = None
+        self.grad = None
+
+    def __call__(self, component_losses, epoch):
+        loss = super(GradNorm, self).__call__(component_losses, epoch)
+        if loss.requires_grad:  # training iterations only
+            self.grad = self.weight_gradient(component_losses)
+        return loss
+
+    def weight_gradient(self, component_losses):
+        norms = torch.stack([torch.sqrt(sum(g.float().pow(2).sum() for g in
+                                            torch.autograd.grad(l, self.shared_parameters, retain_graph=True)))
+                             for l in component_losses])
+        costs = torch.stack(component_losses).detach().float()
+        if self.initial_cost is None:
+            self.initial_cost = costs
+        rates = costs / self.initial_cost.to(costs.device)
+        grad_norms = self.lambda_weight * norms
+        target = grad_norms.mean() * (rates / rates.mean()) ** self.alpha
+        return torch.sign(grad_norms - target) * norms
+
+    def observe(self, component_losses, epoch):
+        super(GradNorm, self).observe(component_losses, epoch)
+        w = (self.lambda_weight - self.lr * reduce_mean(self.grad)).clamp(min=0)
+        self.lambda_weight = self.K * w / w.sum()
+        self.grad = None
+
+    def state_dict(self):
+        initial_cost = None if self.initial_cost is None else self.initial_cost.cpu()
+        return dict(super(GradNorm, self).state_dict(), initial_cost=initial_cost)
+
+    def load_state_dict(self, state):
+        super(GradNorm, self).load_state_dict(state)
+        self.initial_cost = state['initial_cost']
+
+
+WEIGHTINGS = {'dwa': DynamicWeightAverage, 'uncertainty': UncertaintyWeighting, 'gradnorm': GradNorm}
@@ -81,6 +81,84 @@ class DenseBlock(nn.Module):
         return c
 
 
+class FiLMBatchNorm(torch.autograd.Function):
+    """leaky_relu(gamma + beta * batch_norm(x)) in training mode, as a single autograd node.
+
+    Only x and the output are saved for backward (the output, whose sign is that of the leaky ReLU input, is kept
+    alive by the next layers anyway). The normalized x, the FiLM output and the tiled gammas and betas are never
+    stored: backward recomputes the normalized x from the batch statistics.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, bias, gamma, beta, eps, negative_slope):
+        # Reduced precision inputs are normalized in float32
+        dtype = torch.promote_types(x.dtype, torch.float32)
+        x32, weight32, bias32, gamma32, beta32 = [t.to(dtype) for t in (x, weight, bias, gamma, beta)]
+        var, mean = torch.var_mean(x32, dim=(0, 2, 3), unbiased=False)
+        invstd = torch.rsqrt(var + eps)
+        # gamma + beta * (weight * x_hat + bias) = scale * x + shift
+        scale = beta32 * (weight32 * invstd)
+        shift = gamma32 + beta32 * (bias32 - weight32 * invstd * mean)
+        out = torch.addcmul(shift[:, :, None, None], x32, scale[:, :, None, None])
+        out = torch.nn.functional.leaky_relu(out, negative_slope).to(x.dtype)
+        ctx.save_for_backward(x, out, weight, bias, beta, mean, invstd)
+        ctx.negative_slope = negative_slope
+        ctx.gamma_dtype = gamma.dtype
+        ctx.mark_non_differentiable(mean, var)
+        return out, mean, var
+
+    @staticmethod
+    def backward(ctx, grad_out, grad_mean, grad_var):
+        x, out, weight, bias, beta, mean, invstd = ctx.saved_tensors
+        weight32, bias32, beta32 = [t.to(mean.dtype) for t in (weight, bias, beta)]
+        x_hat = (x.to(mean.dtype) - mean[:, None, None]) * invstd[:, None, None]
+        grad_z = grad_out.to(mean.dtype)
+        grad_z = torch.where(out > 0, grad_z, grad_z * ctx.negative_slope)
+        sum_z = grad_z.sum(dim=(2, 3))  # [B, C]
+        sum_z_x_hat = (grad_z * x_hat).sum(dim=(2, 3))
+        grad_gamma = sum_z
+        grad_beta = weight32 * sum_z_x_hat + bias32 * sum_z
+        grad_weight = (beta32 * sum_z_x_hat).sum(0)
+        grad_bias = (beta32 * sum_z).sum(0)
+        # Gradient of x through the batch statistics, with grad_x_hat = grad_z * beta * weight
+        n = x.numel() // x.shape[1]
+        g = beta32 * weight32
+        mean_grad = (g * sum_z).sum(0) / n
+        mean_grad_x_hat = (g * sum_z_x_hat).sum(0) / n
+        grad_x = (grad_z * g[:, :, None, None] - mean_grad[:, None, None] - x_hat * mean_grad_x_hat[:, None, None]) \
+                 * invstd[:, None, None]
+        return grad_x.to(x.dtype), grad_weight.to(weight.dtype), grad_bias.to(bias.dtype), \
+               grad_gamma.to(ctx.gamma_dtype), grad_beta.to(beta.dtype), None, None
+
+
+def film_batch_norm(x, bn, gamma, beta, negative_slope):
+    """leaky_relu(gamma + beta * bn(x)) with gamma, beta [B, C] broadcast over the feature maps x [B, C, H, W].
+
+    Training uses FiLMBatchNorm and updates the running statistics of bn as bn(x) would. In eval mode BatchNorm and
+    FiLM are folded into one per-sample, per-channel scale and shift of x.
+    """
+    if bn.training:
+        out, mean, var = FiLMBatchNorm.apply(x, bn.weight, bn.bias, gamma, beta, bn.eps, negative_slope)
+        with torch.no_grad():
+            bn.num_batches_tracked += 1
+            momentum = 1. / float(bn.num_batches_tracked) if bn.momentum is None else bn.momentum
+            n = x.numel() // x.shape[1]
+            bn.running_mean.mul_(1 - momentum).add_(mean, alpha=momentum)
+            bn.running_var.mul_(1 - momentum).add_(var * n / max(n - 1, 1), alpha=momentum)
+        return out
+    invstd = torch.rsqrt(bn.running_var + bn.eps)
+    scale = beta * (bn.weight * invstd)
+    shift = gamma + beta * (bn.bias - bn.weight * invstd * bn.running_mean)
+    out = torch.addcmul(shift[:, :, None, None].to(x.dtype), x, scale[:, :, None, None].to(x.dtype))
+    return torch.nn.functional.leaky_relu(out, negative_slope, inplace=True)
+
+
+def batch_norm_leaky_relu(x, bn, negative_slope):
+    """leaky_relu(bn(x)) through film_batch_norm with the identity FiLM, for its memory savings in training."""
+    ones = x.new_ones(1, 1).expand(x.shape[0], x.shape[1])
+    return film_batch_norm(x, bn, torch.zeros_like(ones), ones, negative_slope)
+
+
 class ConvolutionalBlock(nn.Module):
     def __init__(self, dim_in, dim_out, kernel_conv=3, kernel_MP=2, stride_conv=1, stride_MP=2, padding=1,
                  bias=True, bn_momentum=0.1, **kwargs):
@@ -115,16 +193,10 @@ class ConvolutionalBlock(nn.Module):
     def forward(self, *args):
         x, gamma, beta = args
         x = self.Conv1(x)
-        x = self.BN1(x)
-        x = self.ReLu1(x)
+        x = batch_norm_leaky_relu(x, self.BN1, self.ReLu1.negative_slope)
         x = self.Conv2(x)
-        x = self.BN2(x)
-        # {(1,16,1,1) , (1,1,H,W)} >>> (1,16,H,W)
-        gamma_tiled = gamma.unsqueeze(2).unsqueeze(2).repeat([1, 1, *x.shape[-2:]])
-        beta_tiled = beta.unsqueeze(2).unsqueeze(2).repeat([1, 1, *x.shape[-2:]])
-        x = gamma_tiled + (beta_tiled * x)
-        # x = self.scale(c).unsqueeze(2).unsqueeze(2) * x + self.bias(c).unsqueeze(2).unsqueeze(2)
-        to_cat = self.ReLu2(x)
+        # ReLu2(gamma + beta * BN2(x)), fused
+        to_cat = film_batch_norm(x, self.BN2, gamma, beta, self.ReLu2.negative_slope)
         to_down = self.MaxPooling(to_cat)
         return to_cat, to_down
 
@@ -177,13 +249,12 @@ class AtrousBlock(nn.Module):
         to_cat = center_crop(to_cat, x.size()[2:4])
         x = torch.cat((x, to_cat), dim=1)
         x = self.Conv1(x)
-        x = self.BN1(x)
+        # Dropout2d scales whole channels by a non-negative factor, so it commutes with the leaky ReLU
+        x = batch_norm_leaky_relu(x, self.BN1, self.ReLu1.negative_slope)
         if self.dropout:
             x = self.DO1(x)
-        x = self.ReLu1(x)
         x = self.Conv2(x)
-        x = self.BN2(x)
-        x = self.ReLu2(x)
+        x = batch_norm_leaky_relu(x, self.BN2, self.ReLu2.negative_slope)
         if self.dropout:
             x = self.DO2(x)
         if not self.finalblock:
@@ -226,16 +297,10 @@ class TransitionBlock(nn.Module):
     def forward(self, *args):
         x, gamma, beta = args
         x = self.Conv1(x)
-        x = self.BN1(x)
-        x = self.ReLu1(x)
+        x = batch_norm_leaky_relu(x, self.BN1, self.ReLu1.negative_slope)
         x = self.Conv2(x)
-        x = self.BN2(x)
-        # {(1,16,1,1) , (1,1,H,W)} >>> (1,16,H,W)
-        gamma_tiled = gamma.unsqueeze(2).unsqueeze(2).repeat([1, 1, *x.shape[-2:]])
-        beta_tiled = beta.unsqueeze(2).unsqueeze(2).repeat([1, 1, *x.shape[-2:]])
-        x = gamma_tiled + (beta_tiled * x)
-        # x = self.scale(c).unsqueeze(2).unsqueeze(2) * x + self.bias(c).unsqueeze(2).unsqueeze(2)
-        x = self.ReLu2(x)
+        # ReLu2(gamma + beta * BN2(x)), fused
+        x = film_batch_norm(x, self.BN2, gamma, beta, self.ReLu2.negative_slope)
         to_up = self.AtrousConv(x)
 
         return to_up
@@ -255,6 +320,8 @@ class CUNet(nn.Module):
         K(int) : Amount of outgoing channels 
         input_channels (int): Amount of input channels
         dimension_vector (tuple/list): Its length defines amount of block. Elements define amount of filters per block
+        cache_film (bool): In eval mode, run the gamma and beta generators once per distinct condition and reuse
+            their outputs (see film)
 
 
 
@@ -263,7 +330,7 @@ class CUNet(nn.Module):
     # TODO Use bilinear interpolation in addition to upconvolutions
 
     def __init__(self, dimensions_vector, K, verbose=False, input_channels=1,
-                 activation=None, dropout=0.5, **kwargs):
+                 activation=None, dropout=0.5, cache_film=True, **kwargs):
         super(CUNet, self).__init__()
         self.K = K
         self.printing = verbose
@@ -273,6 +340,8 @@ class CUNet(nn.Module):
         self.init_assertion(**kwargs)
 
         self.vec = range(len(self.dim))
+        self.cache_film = cache_film
+        self.film_cache = {}
         self.gamma_generator = DenseBlock(len(SOURCES_SUBSET), dropout=dropout, **kwargs)
         self.beta_generator = DenseBlock(len(SOURCES_SUBSET), dropout=dropout, **kwargs)
         self.encoder = self.add_encoder(input_channels, **kwargs)
@@ -334,10 +403,40 @@ class CUNet(nn.Module):
         decoder = nn.Sequential(*decoder)
         return decoder
 
+    def train(self, mode=True):
+        self.film_cache = {}
+        return super(CUNet, self).train(mode)
+
+    def _apply(self, *args, **kwargs):
+        self.film_cache = {}  # moved or cast parameters
+        return super(CUNet, self)._apply(*args, **kwargs)
+
+    def load_state_dict(self, *args, **kwargs):
+        self.film_cache = {}
+        return super(CUNet, self).load_state_dict(*args, **kwargs)
+
+    def film(self, c):
+        """Gammas and betas of the conditions c. In eval mode the generators are deterministic (running BatchNorm
+        statistics, no dropout), so with cache_film their outputs are computed once per distinct condition, cached
+        until the model is trained, moved or loaded again, and gathered for the batch."""
+        if self.training or not self.cache_film:
+            return self.gamma_generator(c), self.beta_generator(c)
+        conditions, inverse = torch.unique(c, dim=0, return_inverse=True)
+        keys = [tuple(condition) for condition in conditions.tolist()]
+        missing = [i for i, key in enumerate(keys) if key not in self.film_cache]
+        if missing:
+            with torch.no_grad():
+                gammas = self.gamma_generator(conditions[missing])
+                betas = self.beta_generator(conditions[missing])
+            for i, gamma, beta in zip(missing, gammas, betas):
+                self.film_cache[keys[i]] = (gamma, beta)
+        gammas = torch.stack([self.film_cache[key][0] for key in keys])
+        betas = torch.stack([self.film_cache[key][1] for key in keys])
+        return gammas[inverse], betas[inverse]
+
     def forward(self, *args):
         x, c = args
-        gammas = self.gamma_generator(c)
-        betas = self.beta_generator(c)
+        gammas, betas = self.film(c)
         init_index = 0
         if self.printing:
             print('CUNet input size {0}'.format(x.size()))
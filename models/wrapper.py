@@ -1,6 +1,5 @@
 import torch
-from utils.utils import warpgrid
-import torch.nn.functional as F
+from utils.utils import warp_log_freq_scale, linearize_log_freq_scale, full_precision
 from settings import *
 
 
@@ -10,25 +9,21 @@ class Wrapper(torch.nn.Module):
         self.L = len(SOURCES_SUBSET)
         self.model = model
         self.main_device = main_device
-        self.grid_warp = torch.from_numpy(
-            warpgrid(BATCH_SIZE, 256, STFT_WIDTH, warp=True)).to(self.main_device)
 
     def forward(self, x):
-        if x.shape[0] == BATCH_SIZE:
-            mags = F.grid_sample(x, self.grid_warp)
-        else:  # for the last batch, where the number of samples are generally lesser than the batch_size
-            custom_grid_warp = torch.from_numpy(
-                warpgrid(x.shape[0], 256, STFT_WIDTH, warp=True)).to(self.main_device)
-            mags = F.grid_sample(x, custom_grid_warp)
+        # Warp, mask division and log stay in float32 under mixed precision
+        with full_precision(x.device):
+            x = x.float()
+            mags = warp_log_freq_scale(x)
 
-        gt_masks = torch.div(mags[:, :-1], mags[:, -1].unsqueeze(1).expand(x.shape[0], self.L, *mags.shape[2:]))
-        gt_masks.clamp_(0., 10.)
+            gt_masks = torch.div(mags[:, :-1], mags[:, -1].unsqueeze(1).expand(x.shape[0], self.L, *mags.shape[2:]))
+            gt_masks.clamp_(0., 10.)
 
-        log_mags = torch.log(mags[:, -1].unsqueeze(1)).detach()
+            log_mags = torch.log(mags[:, -1].unsqueeze(1)).detach()
         gt_mags = x[:, :-1]
         mix_mag = x[:, -1].unsqueeze(1)
         pred_masks = self.model(log_mags)
-        pred_masks = torch.relu(pred_masks)
+        pred_masks = torch.relu(pred_masks.float())
         mag_mix_sq = mags[:, -1].unsqueeze(1)
         pred_mags_sq = pred_masks * mag_mix_sq
         gt_mags_sq = gt_masks * mag_mix_sq
@@ -37,6 +32,13 @@ class Wrapper(torch.nn.Module):
                           pred_masks]  # BxKx256x256, BxKx256x256, BxKx512x256, Bx1x512x256, BxKx256x256, BxKx256x256
         return network_output
 
+    def separate(self, mix_mag):
+        """Estimated magnitudes Bx(out channels)x512xT of the sources of the mixture magnitudes Bx1x512xT."""
+        with full_precision(mix_mag.device):
+            log_mags = torch.log(warp_log_freq_scale(mix_mag.float()))
+        pred_masks = torch.relu(self.model(log_mags).float())
+        return mix_mag * linearize_log_freq_scale(pred_masks)
+
 
 class SpecChannelUnetNoMaskWrapper(torch.nn.Module):
     def __init__(self, model, main_device=0):
@@ -44,30 +46,31 @@ class SpecChannelUnetNoMaskWrapper(torch.nn.Module):
         self.L = len(SOURCES_SUBSET)
         self.model = model
         self.main_device = main_device
-        self.grid_warp = torch.from_numpy(
-            warpgrid(BATCH_SIZE, 256, STFT_WIDTH, warp=True)).to(self.main_device)
 
     def forward(self, x):
-        if x.shape[0] == BATCH_SIZE:
-            mags = F.grid_sample(x, self.grid_warp)
-        else:  # for the last batch, where the number of samples are generally lesser than the batch_size
-            custom_grid_warp = torch.from_numpy(
-                warpgrid(x.shape[0], 256, STFT_WIDTH, warp=True)).to(self.main_device)
-            mags = F.grid_sample(x, custom_grid_warp)
+        with full_precision(x.device):
+            x = x.float()
+            mags = warp_log_freq_scale(x)
 
-        gt_masks = torch.div(mags[:, :-1], mags[:, -1].unsqueeze(1).expand(x.shape[0], self.L, *mags.shape[2:]))
-        gt_masks.clamp_(0., 10.)
+            gt_masks = torch.div(mags[:, :-1], mags[:, -1].unsqueeze(1).expand(x.shape[0], self.L, *mags.shape[2:]))
+            gt_masks.clamp_(0., 10.)
 
         gt_mags = x[:, :-1]
         mix_mag = x[:, -1].unsqueeze(1)
         pred_mags_sq = self.model(mags[:, -1].unsqueeze(1))
-        pred_mags_sq = torch.relu(pred_mags_sq)
+        pred_mags_sq = torch.relu(pred_mags_sq.float())
         mag_mix_sq = mags[:, -1].unsqueeze(1)
         gt_mags_sq = gt_masks * mag_mix_sq
 
         network_output = [gt_mags_sq, pred_mags_sq, gt_mags, mix_mag, gt_masks, gt_masks]  # BxKx256x256, BxKx256x256, BxKx512x256, Bx1x512x256, BxKx256x256, BxKx256x256
         return network_output
 
+    def separate(self, mix_mag):
+        """Estimated magnitudes BxKx512xT of the sources of the mixture magnitudes Bx1x512xT."""
+        with full_precision(mix_mag.device):
+            mags = warp_log_freq_scale(mix_mag.float())
+        return linearize_log_freq_scale(torch.relu(self.model(mags).float()))
+
 
 class CUNetWrapper(torch.nn.Module):
     def __init__(self, model, main_device=0):
@@ -75,26 +78,21 @@ class CUNetWrapper(torch.nn.Module):
         self.L = len(SOURCES_SUBSET)
         self.model = model
         self.main_device = main_device
-        self.grid_warp = torch.from_numpy(
-            warpgrid(BATCH_SIZE, 256, STFT_WIDTH, warp=True)).to(self.main_device)
 
     def forward(self, x):
         x, conditions = x
-        if x.shape[0] == BATCH_SIZE:
-            mags = F.grid_sample(x, self.grid_warp)
-        else:  # for the last batch, where the number of samples are generally lesser than the batch_size
-            custom_grid_warp = torch.from_numpy(
-                warpgrid(x.shape[0], 256, STFT_WIDTH, warp=True)).to(self.main_device)
-            mags = F.grid_sample(x, custom_grid_warp)
+        with full_precision(x.device):
+            x = x.float()
+            mags = warp_log_freq_scale(x)
 
-        gt_masks = torch.div(mags[:, :-1], mags[:, -1].unsqueeze(1))
-        gt_masks.clamp_(0., 10.)
+            gt_masks = torch.div(mags[:, :-1], mags[:, -1].unsqueeze(1))
+            gt_masks.clamp_(0., 10.)
 
-        log_mags = torch.log(mags[:, -1].unsqueeze(1)).detach()
+            log_mags = torch.log(mags[:, -1].unsqueeze(1)).detach()
         gt_mags = x[:, :-1]
         mix_mag = x[:, -1].unsqueeze(1)
         pred_masks = self.model(log_mags, conditions)
-        pred_masks = torch.relu(pred_masks)
+        pred_masks = torch.relu(pred_masks.float())
         mag_mix_sq = mags[:, -1].unsqueeze(1)
         pred_mags_sq = pred_masks * mag_mix_sq
         gt_mags_sq = gt_masks * mag_mix_sq
@@ -102,3 +100,13 @@ class CUNetWrapper(torch.nn.Module):
         network_output = [gt_mags_sq, pred_mags_sq, gt_mags, mix_mag, gt_masks,
                           pred_masks]  # BxKx256x256, BxKx256x256, BxKx512x256, Bx1x512x256, BxKx256x256, BxKx256x256
         return network_output
+
+    def separate(self, mix_mag):
+        """Estimated magnitudes BxKx512xT of the sources of the mixture magnitudes Bx1x512xT, from a single forward
+        pass over K copies of the batch, each copy conditioned on one source."""
+        with full_precision(mix_mag.device):
+            log_mags = torch.log(warp_log_freq_scale(mix_mag.float()))
+        conditions = torch.eye(self.L, device=mix_mag.device).repeat_interleave(mix_mag.shape[0], dim=0)
+        pred_masks = torch.relu(self.model(log_mags.repeat(self.L, 1, 1, 1), conditions).float())
+        pred_masks = pred_masks.view(self.L, mix_mag.shape[0], *pred_masks.shape[2:]).transpose(0, 1)
+        return mix_mag * linearize_log_freq_scale(pred_masks)
@@ -29,6 +29,9 @@ BATCH_SIZE = 16                      #Set the batch size
 LR = 0.01                            #Set the learning rate  
 EPOCHS = 60000  # 500                #Set the maximum number of epochs
 DWA_TEMP = 2                         #Set the temperature for DWA (only relevant for DWA experiments) 
+UNCERTAINTY_LR = 0.01                #Set the learning rate of the log variances (only relevant for uncertainty experiments)
+GRADNORM_ALPHA = 1.5                 #Set the restoring force alpha of GradNorm (only relevant for gradnorm experiments)
+GRADNORM_LR = 0.025                  #Set the learning rate of the GradNorm weights (only relevant for gradnorm experiments)
 MOMENTUM = 0.9                       #Set the optimizer momentum
 DROPOUT = 0.1                        #Set the dropout
 WEIGHT_DECAY = 0                     #Set the weight decay
@@ -40,6 +43,14 @@ TRACKGRAD = False
 ACTIVATION = None
 INPUT_CHANNELS = 1                   #Number of input channels to the model
 EARLY_STOPPING_PATIENCE = 60         #Set the early stopping patience
+EXPERIMENT = 'energy_based'          #Training experiment run by train/trainer.py (see EXPERIMENTS there)
+WARP_OPERATOR = 'grid_sample'        #Log-frequency warp: 'grid_sample' or 'banded' (precomputed LogFreqWarp taps)
+AMP = False                          #Set True for mixed-precision training (autocast + loss scaling)
+AMP_DTYPE = 'bfloat16'               #Reduced precision type: 'float16' (GPU) or 'bfloat16' (GPU/CPU)
+DISTRIBUTED = False                  #Set True for DistributedDataParallel training, launched with torchrun (one process per GPU or CPU worker)
+DIST_BACKEND = 'gloo'                #Process group backend: 'gloo' (CPU or GPU) or 'nccl' (GPU only)
+REMIX = False                        #Set True to train on mixtures rebuilt on the fly from the stems of different samples of the batch (not for cunet)
+REMIX_GAINS = (0.25, 1.25)           #Range of the random gains applied to every remixed stem
 
 # CUNet Settings
 FILTERS_LAYER_1 = 32
@@ -47,27 +58,23 @@ Z_DIM = 4
 N_CONDITIONS = 4064
 N_NEURONS = [32, 512, 4096]
 CUNET_DROPOUT = 0.1
-
-##### ENERGY STATS #####
-ACC_ENERGY = 687.5261
-BAS_ENERGY = 252.7046
-DRU_ENERGY = 218.6938
-MIX_ENERGY = 858.8005
-OTH_ENERGY = 216.4932
-VOC_ENERGY = 173.4346
-
-#### SPECTROGRAM CHANNEL U-NET ####
-if TYPE == '2src':
-    w_1 = 0.7986   # w_V x VOC_ENERGY = (1-w_V) x ACC_ENERGY, w_V = ACC_ENERGY/(ACC_ENERGY + VOC_ENERGY)
-    w_2 = 1 - w_1  # w_V = 687.5261/(687.5261 + 173.4346)
-else:
-    w_1 = 0.3048   # w_V*V_NRG = w_D*D_NRG = w_B*B_NRG = w_O*O_ENERGY
-    w_2 = 0.2417   # w_V + w_D + w_B + w_O = 1
-    w_3 = 0.2092   # w_V*173.4346 = w_D*218.6938 = w_B*252.7046 = w_O*216.4932
-    w_4 = 0.2442
+GROUPED_CONDITIONS = False           #Load every sample once and emit all of its condition variants together (changes the batch composition)
 
 #### TENSORBOARD CONFIG #####
 PARAMETER_SAVE_FREQUENCY = 100           #Set the parameter save frequency for tensorboard
+METRICS_FLUSH_STEPS = 50                 #Iterations whose losses stay on the device before being read back for tqdm, the log and tensorboard
+METRICS_CALIBRATION_WINDOWS = 2          #Windows of METRICS_FLUSH_STEPS iterations read back every iteration at the start of training, to report the time buffering saves (0 disables)
+DUMP_WORKERS = 4                         #Number of background processes writing the audio and spectrogram dumps
+DUMP_QUEUE_SIZE = 32                     #Samples waiting to be dumped; training drops samples beyond it, testing waits
+
+#### FULL-TRACK SEPARATION (eval/separate.py) ####
+SEPARATION_HOP = STFT_WIDTH // 2         #Frames between consecutive model windows, which are cross-faded where they overlap
+SEPARATION_BATCH_SIZE = BATCH_SIZE       #Windows per forward pass
+EVAL_WORKERS = 8                         #Number of tracks evaluated in parallel by eval/eval_metrics.py
+EVAL_WINDOW = TARGET_SAMPLING_RATE       #Samples per BSS-eval window (1s, as museval); None evaluates whole tracks
+EVAL_HOP = EVAL_WINDOW                   #Samples between consecutive BSS-eval windows
+EVAL_FILTER_LENGTH = 512                 #Taps of the BSS-eval distortion filters
+EVAL_WINDOW_BATCH = 8                    #BSS-eval windows solved at once
 
 ##### Main Directory Path #####
 #MAIN_DIR_PATH = '/media/venkatesh/slave'
@@ -86,6 +93,12 @@ MUSDB_WAVS_FOLDER_PATH = os.path.join(MUSDB_FOLDER_PATH, 'musdb18_wavs')
 ENERGY_PROFILE_FOLDER = os.path.join(MUSDB_FOLDER_PATH, 'energy_profile')
 MUSDB_SPLITS_PATH = os.path.join(MUSDB_FOLDER_PATH, 'musdbsplit')
 CHUNKS_PATH = os.path.join(MUSDB_FOLDER_PATH, 'musdb_chunks')
+MUSDB_SHARDS_PATH = os.path.join(MUSDB_FOLDER_PATH, 'musdbshards')
+SHARD_DTYPE = 'float16'                 #Storage type of the magnitudes and phases in the spectrogram shards ('float16' or 'float32')
+PREPROCESSING_MANIFEST = os.path.join(MUSDB_SHARDS_PATH, 'manifest.json')  #Per-track record of processed tracks, used to resume preprocessing
+ENERGY_STATS_PATH = os.path.join(MUSDB_SHARDS_PATH, 'energy_stats.csv')  #Track-wise source energies, which set the energy based loss weights (see dataset/energy_stats.py)
+PREPROCESSING_WORKERS = 8               #Number of tracks preprocessed in parallel
+PREPROCESSING_DEVICE = 0                #GPU id used for the STFT during preprocessing, or 'cpu'. Falls back to the CPU when no GPU is available
 
 SOURCES_SUBSET_ID = [SOURCES.index(i) for i in SOURCES_SUBSET]
 ENERGY_THRESHOLD = 0                    #Set the energy threshold for considering a sample as silent.
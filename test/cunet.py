@@ -9,6 +9,7 @@ from flerken.framework.pytorchframework import set_training, config, ctx_iter
 from flerken.framework import val
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from utils.utils import *
+from utils.dumps import DumpService
 from models.wrapper import CUNetWrapper
 from tqdm import tqdm
 from loss.losses import *
@@ -24,8 +25,6 @@ class CUNetTest(pytorchfw):
         self.audio_dumps_folder = os.path.join(self.audio_dumps_path, TEST_UNET_CONFIG, 'test')
         self.visual_dumps_folder = os.path.join(self.visual_dumps_path, TEST_UNET_CONFIG, 'test')
         self.main_device = main_device
-        self.grid_unwarp = torch.from_numpy(
-            warpgrid(BATCH_SIZE, NFFT // 2 + 1, STFT_WIDTH, warp=False)).to(self.main_device)
         self.val_iterations = 0
 
     def print_args(self):
@@ -75,15 +74,18 @@ class CUNetTest(pytorchfw):
     def train(self):
 
         self.print_args()
+        self.dumps = DumpService()
         validation_data = CUnetInput('test')
         self.val_loader = torch.utils.data.DataLoader(validation_data,
-                                                      batch_size=BATCH_SIZE,
+                                                      batch_size=validation_data.loader_batch_size,
+                                                      collate_fn=validation_data.collate_fn,
                                                       shuffle=True,
                                                       num_workers=10)
         for self.epoch in range(self.start_epoch, self.EPOCHS):
             with val(self):
                 self.run_epoch()
             break
+        self.dumps.close()
 
     def validate_epoch(self):
         with tqdm(self.val_loader, desc='Validation: [{0}/{1}]'.format(self.epoch, self.EPOCHS)) as pbar, ctx_iter(
@@ -103,44 +105,15 @@ class CUNetTest(pytorchfw):
         if self.iterating:
             text = visualization[1]
             self.writer.add_text('Filepath', text[-1], self.val_iterations)
-            phase = visualization[0].detach().cpu().clone().numpy()
             gt_mags_sq, pred_mags_sq, gt_mags, mix_mag, gt_masks, pred_masks = output
-            if len(text) == BATCH_SIZE:
-                grid_unwarp = self.grid_unwarp
-            else:  # for the last batch, where the number of samples are generally lesser than the batch_size
-                grid_unwarp = torch.from_numpy(
-                    warpgrid(len(text), NFFT // 2 + 1, STFT_WIDTH, warp=False)).to(self.main_device)
-            pred_masks_linear = linearize_log_freq_scale(pred_masks, grid_unwarp)
-            gt_masks_linear = linearize_log_freq_scale(gt_masks, grid_unwarp)
+            pred_masks_linear = linearize_log_freq_scale(pred_masks)
+            gt_masks_linear = linearize_log_freq_scale(gt_masks)
             oracle_spec = (mix_mag * gt_masks_linear)
             pred_spec = (mix_mag * pred_masks_linear)
             conditions = visualization[-1]
-            for i, sample in enumerate(text):
-                j = torch.nonzero(conditions[i])
-                source = SOURCES_SUBSET[j]
-                sample_id = os.path.basename(sample)[:-4]
-                folder_name = os.path.basename(os.path.dirname(sample))
-                pred_audio_out_folder = os.path.join(self.audio_dumps_folder, folder_name, sample_id)
-                create_folder(pred_audio_out_folder)
-                visuals_out_folder = os.path.join(self.visual_dumps_folder, folder_name, sample_id)
-                create_folder(visuals_out_folder)
-
-                gt_audio = torch.from_numpy(
-                    istft_reconstruction(gt_mags.detach().cpu().numpy()[i][0], phase[i][0], HOP_LENGTH))
-                pred_audio = torch.from_numpy(
-                    istft_reconstruction(pred_spec.detach().cpu().numpy()[i][0], phase[i][0], HOP_LENGTH))
-                librosa.output.write_wav(os.path.join(pred_audio_out_folder, 'GT_' + source + '.wav'),
-                                         gt_audio.cpu().detach().numpy(), TARGET_SAMPLING_RATE)
-                librosa.output.write_wav(os.path.join(pred_audio_out_folder, 'PR_' + source + '.wav'),
-                                         pred_audio.cpu().detach().numpy(), TARGET_SAMPLING_RATE)
-
-                ### PLOTTING MAG SPECTROGRAMS ###
-                save_spectrogram(gt_mags[i][0].unsqueeze(0).detach().cpu(),
-                                 os.path.join(visuals_out_folder, source), '_MAG_GT.png')
-                save_spectrogram(oracle_spec[i][0].unsqueeze(0).detach().cpu(),
-                                 os.path.join(visuals_out_folder, source), '_MAG_ORACLE.png')
-                save_spectrogram(pred_spec[i][0].unsqueeze(0).detach().cpu(),
-                                 os.path.join(visuals_out_folder, source), '_MAG_ESTIMATE.png')
+            targets = [[(0, 0, SOURCES_SUBSET[int(torch.nonzero(condition))])] for condition in conditions]
+            self.dumps.dump_batch(text, visualization[0], gt_mags, oracle_spec, pred_spec, targets,
+                                  self.audio_dumps_folder, self.visual_dumps_folder, block=True)
 
             ### PLOTTING MAG SPECTROGRAMS ###
             plot_spectrogram(self.writer, gt_mags.detach().cpu().view(-1, 1, 512, 256)[:8],
@@ -0,0 +1,26 @@
+import numpy as np
+from mir_eval.separation import bss_eval_sources
+from utils.bss_eval import bss_eval_framewise
+
+WINDOW = 2048
+
+
+def test_zero_mean_window_is_not_silent():
+    rng = np.random.RandomState(0)
+    references = rng.randn(2, 3 * WINDOW)
+    # Integer samples, so that the sum of the window is exactly zero although none of its samples is
+    zero_mean = rng.randint(-5, 6, WINDOW).astype(np.float64)
+    zero_mean[zero_mean == 0] = 1
+    zero_mean[-1] -= zero_mean.sum()
+    assert zero_mean.sum() == 0 and np.all(zero_mean != 0)
+    references[0, WINDOW:2 * WINDOW] = zero_mean
+    references[1, 2 * WINDOW:] = 0
+    estimates = references + 0.1 * rng.randn(*references.shape)
+
+    metrics, _ = bss_eval_framewise(references, estimates, window=WINDOW, hop=WINDOW)
+
+    expected = bss_eval_sources(references[:, WINDOW:2 * WINDOW], estimates[:, WINDOW:2 * WINDOW],
+                                compute_permutation=False)[:3]
+    np.testing.assert_allclose(metrics[:, :, 1], np.array(expected), rtol=1e-8)
+    # Only the window where a source is entirely zero is skipped
+    assert np.all(np.isfinite(metrics[:, :, :2])) and np.all(np.isnan(metrics[:, :, 2]))
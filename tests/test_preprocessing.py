@@ -0,0 +1,27 @@
+import warnings
+
+import numpy as np
+import torch
+from dataset.preprocessing import _stft
+from settings import *
+
+
+def real_imag_stft(sources):
+    """The former STFT stage: real/imaginary pairs, rebuilt into a complex array on the host."""
+    s = torch.from_numpy(sources).float()
+    shape = s.size()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        stft_output = torch.stft(s.view(-1, shape[-1]), n_fft=NFFT, hop_length=HOP_LENGTH,
+                                 window=torch.hann_window(NFFT), return_complex=False)
+    stft = stft_output.view(*shape[:-1], *stft_output.size()[1:3], 2).numpy()
+    return stft[..., 0] + stft[..., 1] * 1j
+
+
+def test_stft_matches_real_imag_path():
+    sources = np.random.RandomState(0).randn(len(SOURCES) + 1, 2, 4 * NFFT).astype(np.float32)
+    stft = _stft(sources, torch.device('cpu'))
+    expected = real_imag_stft(sources)
+    assert stft.shape == expected.shape
+    assert np.iscomplexobj(stft)
+    np.testing.assert_allclose(stft, expected, rtol=0, atol=1e-6 * np.abs(expected).max())
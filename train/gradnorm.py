@@ -0,0 +1,9 @@
+import sys
+
+sys.path.append('..')
+from trainer import main
+
+if __name__ == '__main__':
+    main('gradnorm')
+
+# Usage python3 gradnorm.py --train/test
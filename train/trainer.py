@@ -0,0 +1,456 @@
+import sys
+
+sys.path.append('..')
+import shutil
+import time
+
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from dataset.dataloaders import UnetInput, CUnetInput
+from dataset.remix import remix_batch
+from flerken import pytorchfw
+from flerken.models import UNet
+from flerken.framework.pytorchframework import set_training, config, ctx_iter, checkpoint_on_key, assert_workdir
+from flerken.framework import train, val
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+from utils.utils import *
+from utils.EarlyStopping import EarlyStopping
+from utils.distributed import init_distributed, get_rank, all_reduce_sum, broadcast_values, broadcast_object
+from utils.dumps import DumpService
+from utils.metrics import MetricsBuffer
+from models.wrapper import Wrapper, SpecChannelUnetNoMaskWrapper, CUNetWrapper
+from models.cunet import CUNet
+from tqdm import tqdm
+from loss.losses import *
+from loss.weighting import WEIGHTINGS
+from settings import *
+
+# Training experiments. Every entry selects the network, wrapper, dataset and criterion of an experiment:
+#   losses:  'total' when the criterion returns the loss alone, 'terms' when it returns [l1, ..., lK, *extra, loss]
+#            and 'components' when it returns [l1, ..., lK] to be combined by the 'weighting' strategy
+#   extra:   names of the tensor scalar items for the terms between the per-source losses and the loss
+#   tracker: tracks the sum of the terms as loss_tracker, which then selects the best checkpoint
+#   masks:   whether the network estimates masks (False when it estimates the spectrograms directly)
+#   dump:    'isolated' (ISOLATED_SOURCE_ID only), 'target' (conditioned target) or 'sources' (every source)
+EXPERIMENTS = {
+    'baseline': dict(model_version='BASELINE', network='unet', wrapper=Wrapper, dataset=UnetInput,
+                     out_channels=1, criterion=SingleSourceDirectLoss, losses='total', dump='isolated'),
+    'cunet': dict(model_version='Conditioned-U-NET', network='cunet', wrapper=CUNetWrapper, dataset=CUnetInput,
+                  criterion=CUNetLoss, losses='total', dump='target'),
+    'dwa': dict(model_version='DWA', criterion=IndividualLosses, losses='components', weighting='dwa',
+                tracker=True),
+    'uncertainty': dict(model_version='UNCERTAINTY', criterion=IndividualLosses, losses='components',
+                        weighting='uncertainty', tracker=True),
+    'gradnorm': dict(model_version='GRADNORM', criterion=IndividualLosses, losses='components', weighting='gradnorm',
+                     tracker=True),
+    'energy_based': dict(model_version='ENERGY BASED', criterion=EnergyBasedLossPowerPMask,
+                         criterion_kwargs={'power': 1}, tracker=True),
+    'energy_based_instantwise': dict(model_version='ENERGY BASED INSTANTWISE', criterion=EnergyBasedLossInstantwise,
+                                     criterion_kwargs={'power': 1}, tracker=True),
+    'energy_based_magnitudes': dict(model_version='ENERGY BASED MAGNITUDES', criterion=EnergyBasedLossPowerP,
+                                    criterion_kwargs={'power': 1}, tracker=True),
+    'grad_based': dict(model_version='GRAD BASED', criterion=GradientLoss, criterion_kwargs={'power': 1},
+                       extra=['lg'], tracker=True),
+    'unit_weighted': dict(model_version='UNIT WEIGHTED', criterion=UnitWeightedLoss),
+    'spec_channel_unet': dict(model_version='Spectrogram Channel Unet', criterion=SpecChannelUnetLoss,
+                              tracker=True),
+    'spec_channel_unet_nomasks': dict(model_version='Spectrogram Channel Unet No Mask',
+                                      wrapper=SpecChannelUnetNoMaskWrapper, masks=False,
+                                      criterion=SpecChannelUnetLoss, tracker=True),
+}
+
+DEFAULT_EXPERIMENT = dict(network='unet', out_channels=K, wrapper=Wrapper, masks=True, dataset=UnetInput,
+                          criterion_kwargs={}, losses='terms', extra=[], tracker=False, weighting=None,
+                          dump='sources', early_stopping=True)
+
+SOURCE_LABELS = {'vocals': 'Voice', 'accompaniment': 'Acc', 'drums': 'Drums', 'bass': 'Bass', 'other': 'Other'}
+EXTRA_LABELS = {'lg': 'Gradient Loss'}
+
+
+def get_experiment(name):
+    if name not in EXPERIMENTS:
+        raise Exception('Non considered experiment {0}. Choose among {1}'.format(name, list(EXPERIMENTS)))
+    return dict(DEFAULT_EXPERIMENT, **EXPERIMENTS[name])
+
+
+class Trainer(pytorchfw):
+    def __init__(self, model, rootdir, workname, experiment, main_device=0, trackgrad=False):
+        super(Trainer, self).__init__(model, rootdir, workname, main_device, trackgrad)
+        self.experiment = experiment
+        self.audio_dumps_path = os.path.join(DUMPS_FOLDER, 'audio')
+        self.visual_dumps_path = os.path.join(DUMPS_FOLDER, 'visuals')
+        self.audio_dumps_folder = None
+        self.visual_dumps_folder = None
+        self.dumps = None
+        self.main_device = main_device
+        self.scaler = make_grad_scaler(self.main_device)
+        # With DISTRIBUTED every process trains a replica on its share of the data. Rank 0 alone owns the experiment
+        # folder, database row, checkpoints, dumps and TensorBoard writer
+        self.distributed = DISTRIBUTED
+        self.rank = get_rank()
+        self.is_main_process = self.rank == 0
+        if REMIX and experiment['dataset'] is not UnetInput:
+            raise Exception('REMIX is only available for the experiments trained on UnetInput')
+
+        self.source_items = []
+        if experiment['losses'] != 'total':
+            self.source_items = ['l' + str(i + 1) for i in range(K)]
+        for tsi in self.source_items + experiment['extra']:
+            self.set_tensor_scalar_item(tsi)
+        if experiment['tracker']:
+            self.set_tensor_scalar_item('loss_tracker')
+        self.EarlyStopChecker = EarlyStopping(patience=EARLY_STOPPING_PATIENCE)
+        self.val_iterations = 0
+        self.step_items = {}
+        self.pbar = None
+        self.metrics = None
+
+    def print_args(self):
+        setup_logger('log_info', self.workdir + '/info_file.txt',
+                     FORMAT="[%(asctime)-15s %(filename)s:%(lineno)d %(funcName)s] %(message)s]")
+        logger = logging.getLogger('log_info')
+        self.print_info(logger)
+        logger.info(f'\r\t Spectrogram data dir: {ROOT_DIR}\r'
+                    'TRAINING PARAMETERS: \r\t'
+                    f'Run name: {self.workname}\r\t'
+                    f'Experiment: {self.model_version}\r\t'
+                    f'Batch size {BATCH_SIZE} \r\t'
+                    f'Optimizer {OPTIMIZER} \r\t'
+                    f'Initializer {INITIALIZER} \r\t'
+                    f'Epochs {EPOCHS} \r\t'
+                    f'LR General: {LR} \r\t'
+                    f'SGD Momentum {MOMENTUM} \r\t'
+                    f'Weight Decay {WEIGHT_DECAY} \r\t'
+                    f'Pre-trained model:  {PRETRAINED} \r'
+                    'MODEL PARAMETERS \r\t'
+                    f'Nº instruments (K) {K} \r\t'
+                    f'U-Net activation: {ACTIVATION} \r\t'
+                    f'U-Net Input channels {INPUT_CHANNELS}\r\t'
+                    f'U-Net Batch normalization {USE_BN} \r\t')
+
+    def set_optim(self, *args, **kwargs):
+        if OPTIMIZER == 'adam':
+            return torch.optim.Adam(*args, **kwargs)
+        elif OPTIMIZER == 'SGD':
+            return torch.optim.SGD(*args, **kwargs)
+        else:
+            raise Exception('Non considered optimizer. Implement it')
+
+    def hyperparameters(self):
+        self.dataparallel = False
+        self.initializer = INITIALIZER
+        self.EPOCHS = EPOCHS
+        self.optimizer = self.set_optim(self.model.parameters(), momentum=MOMENTUM, lr=LR)
+        self.LR = LR
+        self.scheduler = ReduceLROnPlateau(self.optimizer, patience=7, threshold=3e-4)
+
+    def set_config(self):
+        self.batch_size = BATCH_SIZE
+        self.criterion = self.experiment['criterion'](self.main_device, **self.experiment['criterion_kwargs'])
+        self.weighting = None
+        if self.experiment['weighting'] is not None:
+            self.weighting = WEIGHTINGS[self.experiment['weighting']](self.model)
+
+    def get_loader(self, state):
+        data = self.experiment['dataset'](state)
+        sampler = DistributedSampler(data, shuffle=True) if self.distributed else None
+        return torch.utils.data.DataLoader(data,
+                                           batch_size=getattr(data, 'loader_batch_size', BATCH_SIZE),
+                                           collate_fn=getattr(data, 'collate_fn', None),
+                                           shuffle=sampler is None,
+                                           sampler=sampler,
+                                           num_workers=10)
+
+    def _train(self):
+        if self.is_main_process:
+            super(Trainer, self)._train()
+        else:
+            # The replicas start from the weights of rank 0, which DistributedDataParallel broadcasts on wrapping
+            self.tensorboard_enabled = False
+            self.loaded_model = True
+            self.start_epoch = 0
+            self.absolute_iter = 0
+            self.train_iter_logger = logging.getLogger('train_iter_log')
+            self.err_logger = logging.getLogger('error_log')
+        if self.distributed:
+            self.start_epoch, self.absolute_iter = map(int, broadcast_values([self.start_epoch, self.absolute_iter],
+                                                                             self.main_device))
+            if self.weighting is not None:
+                self.weighting.load_state_dict(broadcast_object(self.weighting.state_dict()))
+            self.model = DistributedDataParallel(self.model,
+                                                 device_ids=[self.main_device] if self.cuda else None)
+
+    def _loadcheckpoint(self):
+        super(Trainer, self)._loadcheckpoint()
+        if self.weighting is None:
+            return
+        # Same checkpoint as flerken resumes from: the best one if there is one, else the last one
+        path = os.path.join(self.workdir, 'best' + self.checkpoint_name)
+        if not os.path.isfile(path):
+            path = os.path.join(self.workdir, self.checkpoint_name)
+        checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+        if checkpoint.get('weighting') is not None:
+            self.weighting.load_state_dict(checkpoint['weighting'])
+
+    def __update_db__(self):
+        if self.is_main_process:
+            super(Trainer, self).__update_db__()
+
+    def update_epoch_items(self):
+        """Closes the epoch of the tensor scalar items. In distributed mode their epoch means are taken over the
+        iterations of all the processes, so that every rank schedules the LR and stops early on the same loss."""
+        for tsi in self.tensor_scalar_items:
+            timers = getattr(self, tsi + '_').data
+            if self.distributed:
+                array = timers.tuple[self.state].array
+                total, count = all_reduce_sum([sum(array.hist), len(array.hist)], self.main_device)
+                array.hist = [total / count]
+            setattr(self, tsi, timers.update_epoch(self.state))
+
+    @config
+    @set_training
+    def train(self):
+
+        if self.is_main_process:
+            self.print_args()
+            self.audio_dumps_folder = os.path.join(self.audio_dumps_path, self.workname, 'train')
+            create_folder(self.audio_dumps_folder)
+            self.visual_dumps_folder = os.path.join(self.visual_dumps_path, self.workname, 'train')
+            create_folder(self.visual_dumps_folder)
+            self.dumps = DumpService()
+
+        self.metrics = {'train': MetricsBuffer(self.publish_metrics, calibration_windows=METRICS_CALIBRATION_WINDOWS,
+                                               logger=self.train_iter_logger, verbose=self.is_main_process),
+                        'val': MetricsBuffer(self.publish_metrics)}
+        self.train_loader = self.get_loader('train')
+        self.val_loader = self.get_loader('val')
+        for self.epoch in range(self.start_epoch, self.EPOCHS):
+            if self.distributed:
+                self.train_loader.sampler.set_epoch(self.epoch)
+            if self.weighting is not None:
+                self.weighting.start_epoch(self.epoch)
+            with train(self):
+                self.run_epoch(self.train_iter_logger)
+            self.scheduler.step(self.loss)
+            with val(self):
+                self.run_epoch()
+            self.__update_db__()
+            if self.weighting is not None and self.is_main_process:
+                self.weighting.log(self.writer, self.epoch)
+            if self.experiment['early_stopping']:
+                stop = self.EarlyStopChecker.check_improvement(self.loss_.data.tuple['val'].epoch_array.val,
+                                                               self.epoch)
+                if stop:
+                    print('Early Stopping Epoch : [{0}], '
+                          'Best Checkpoint Epoch : [{1}]'.format(self.epoch,
+                                                                 self.EarlyStopChecker.best_epoch))
+                    break
+        if self.dumps is not None:
+            self.dumps.close()
+
+    def compute_loss(self, inputs):
+        """Runs the model and the criterion and sets the loss terms of the experiment."""
+        with autocast(self.main_device):
+            output = self.model(*inputs) if isinstance(inputs, list) and self.experiment['network'] == 'unet' \
+                else self.model(inputs)
+            terms = self.criterion(output)
+        if self.experiment['losses'] == 'total':
+            self.set_step_items(loss=terms)
+            return output, None
+        component_losses = terms[:K]
+        items = dict(zip(self.source_items + self.experiment['extra'], terms))
+        if self.experiment['losses'] == 'components':
+            items['loss'] = self.weighting(component_losses, self.epoch)
+        else:
+            items['loss'] = terms[-1]
+        if self.experiment['tracker']:
+            items['loss_tracker'] = sum(terms[:K + len(self.experiment['extra'])])
+        self.set_step_items(**items)
+        return output, component_losses
+
+    def set_step_items(self, **items):
+        """Sets the tensor scalar items of an iteration. Assigning them would read every item back to the host at
+        once; instead they stay on the device and reach flerken through the metrics buffer of the state."""
+        for name, value in items.items():
+            setattr(self, '_' + name, value)
+        self.step_items = items
+        self.loss_.data.end = time.time()  # start of the data time of the next iteration
+
+    def publish_metrics(self, names, steps, values, step_times):
+        """Hands the iterations read back by a metrics buffer to the tensor scalar items, TensorBoard, tqdm and the
+        iteration log, as assigning the items every iteration used to."""
+        for step, row, step_time in zip(steps, values, step_times):
+            for name, value in zip(names, row):
+                array = getattr(self, name + '_').data.tuple[self.state].array
+                array.update(value)
+                if self.tensorboard_enabled and array.enabled:
+                    self.writer.add_scalars('%s_iter' % name, {self.state: value}, step)
+            if step_time is not None:
+                self.loss_.data.batch_time.update(step_time)
+        self.pbar.set_postfix(loss=values[-1][names.index('loss')])
+        if self.state == 'train':
+            self.loss_.data.print_logger(self.epoch, steps[-1] - self.epoch_start_iter - 1, self.train_iterations,
+                                         self.train_iter_logger)
+
+    def train_epoch(self, logger):
+        self.train_iterations = len(iter(self.train_loader))
+        self.epoch_start_iter = self.absolute_iter
+        self.metrics['train'].start()
+        with tqdm(self.train_loader, desc='Epoch: [{0}/{1}]'.format(self.epoch, self.EPOCHS),
+                  disable=not self.is_main_process) as self.pbar, ctx_iter(self):
+            for inputs, visualization in self.pbar:
+                try:
+                    self.absolute_iter += 1
+                    inputs = self._allocate_tensor(inputs)
+                    if REMIX:
+                        inputs, visualization = remix_batch(inputs, visualization)
+                    output, component_losses = self.compute_loss(inputs)
+                    self.optimizer.zero_grad()
+                    self.scaler.scale(self.loss).backward()
+                    if self.weighting is not None:
+                        self.weighting.observe(component_losses, self.epoch)
+                    self.scaler.unscale_(self.optimizer)
+                    self.gradients()
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                    self.metrics['train'].update(self.absolute_iter, self.step_items)
+                    self.tensorboard_writer(self.loss, output, None, self.absolute_iter, visualization)
+                except Exception as e:
+                    try:
+                        if self.is_main_process:
+                            self.save_checkpoint(filename=os.path.join(self.workdir, 'checkpoint_backup.pth'))
+                    except:
+                        self.err_logger.error('Failed to deal with exception. Could not save backup at {0} \n'
+                                              .format(os.path.join(self.workdir, 'checkpoint_backup.pth')))
+                    self.err_logger.error(str(e))
+                    raise e
+            self.metrics['train'].close()
+        self.update_epoch_items()
+        if self.weighting is not None:
+            # Before the checkpoint, so that it holds the averages of this epoch
+            self.weighting.end_epoch(self.epoch, self.main_device)
+        self.tensorboard_writer(self.loss, output, None, self.absolute_iter, visualization)
+        if self.is_main_process:
+            self.save_checkpoint()
+
+    def validate_epoch(self):
+        self.metrics['val'].start()
+        with tqdm(self.val_loader, desc='Validation: [{0}/{1}]'.format(self.epoch, self.EPOCHS),
+                  disable=not self.is_main_process) as self.pbar, ctx_iter(self):
+            for inputs, visualization in self.pbar:
+                self.val_iterations += 1
+                self.loss_.data.update_timed()
+                inputs = self._allocate_tensor(inputs)
+                output, _ = self.compute_loss(inputs)
+                self.metrics['val'].update(self.val_iterations, self.step_items)
+                self.tensorboard_writer(self.loss, output, None, self.absolute_iter, visualization)
+            self.metrics['val'].close()
+        self.update_epoch_items()
+        self.tensorboard_writer(self.loss, output, None, self.absolute_iter, visualization)
+
+    @checkpoint_on_key
+    @assert_workdir
+    def save_checkpoint(self, filename=None):
+        state = {
+            'epoch': self.epoch + 1,
+            'iter': self.absolute_iter + 1,
+            'arch': self.model_version,
+            # Unwrapped, so that the checkpoints of distributed runs load into a plain model
+            'state_dict': (self.model.module if self.distributed else self.model).state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'loss': self.loss_,
+            'key': self.key,
+            'scheduler': self.scheduler.state_dict(),
+            'weighting': None if self.weighting is None else self.weighting.state_dict()
+        }
+        if filename is None:
+            filename = os.path.join(self.workdir, self.checkpoint_name)
+
+        elif isinstance(filename, str):
+            filename = os.path.join(self.workdir, filename)
+        print('Saving checkpoint at : {}'.format(filename))
+        torch.save(state, filename)
+        best_item = self.loss_tracker_ if self.experiment['tracker'] else self.loss_
+        if best_item.data.is_best:
+            shutil.copyfile(filename, os.path.join(self.workdir, 'best' + self.checkpoint_name))
+        print('Checkpoint saved successfully')
+
+    def dump_targets(self):
+        """(ground truth channel, predicted channel, name) of the estimates dumped by tensorboard_writer."""
+        if self.experiment['dump'] == 'isolated':
+            return [(ISOLATED_SOURCE_ID, 0, SOURCES_SUBSET[ISOLATED_SOURCE_ID])]
+        elif self.experiment['dump'] == 'target':
+            return [(0, 0, 'TARGET')]
+        return [(j, j, source) for j, source in enumerate(SOURCES_SUBSET)]
+
+    def tensorboard_writer(self, loss, output, gt, absolute_iter, visualization):
+        if not self.is_main_process:
+            return
+        if self.state == 'train':
+            iter_val = absolute_iter
+        elif self.state == 'val':
+            iter_val = self.val_iterations
+
+        if self.iterating:
+            if iter_val % PARAMETER_SAVE_FREQUENCY == 0:
+                text = visualization[1]
+                self.writer.add_text('Filepath', text[-1], iter_val)
+                gt_mags_sq, pred_mags_sq, gt_mags, mix_mag, gt_masks, pred_masks = output
+                if self.experiment['masks']:
+                    pred_spec = mix_mag * linearize_log_freq_scale(pred_masks)
+                else:
+                    pred_spec = linearize_log_freq_scale(pred_mags_sq)
+                gt_masks_linear = linearize_log_freq_scale(gt_masks)
+                oracle_spec = (mix_mag * gt_masks_linear)
+                targets = self.dump_targets()
+                self.dumps.dump_batch(text, visualization[0], gt_mags, oracle_spec, pred_spec, targets,
+                                      self.audio_dumps_folder, self.visual_dumps_folder)
+
+                ### PLOTTING MAG SPECTROGRAMS ON TENSORBOARD ###
+                gt_channels = [j for j, _, _ in targets]
+                plot_spectrogram(self.writer, gt_mags[:, gt_channels].detach().cpu().view(-1, 1, 512, 256)[:8],
+                                 self.state + '_GT_MAG', iter_val)
+                plot_spectrogram(self.writer, pred_spec.detach().cpu().view(-1, 1, 512, 256)[:8],
+                                 self.state + '_PRED_MAG', iter_val)
+
+        else:
+            for tsi, source in zip(self.source_items, SOURCES_SUBSET):
+                self.writer.add_scalars(self.state + ' losses_epoch',
+                                        {SOURCE_LABELS[source] + ' Est Loss': getattr(self, tsi)}, self.epoch)
+            for tsi in self.experiment['extra']:
+                self.writer.add_scalars(self.state + ' losses_epoch', {EXTRA_LABELS[tsi]: getattr(self, tsi)},
+                                        self.epoch)
+
+
+def build_model(experiment, main_device=MAIN_DEVICE):
+    if experiment['network'] == 'cunet':
+        network = CUNet([32, 64, 128, 256, 512, 1024, 2048], 1, None, dropout=CUNET_DROPOUT)
+    else:
+        network = UNet([32, 64, 128, 256, 512, 1024, 2048], experiment['out_channels'], None, verbose=False,
+                       useBN=True, dropout=DROPOUT)
+    return experiment['wrapper'](network, main_device=main_device)
+
+
+def main(name=EXPERIMENT):
+    os.environ['CUDA_VISIBLE_DEVICES'] = '0,1,2'
+    experiment = get_experiment(name)
+    main_device = init_distributed() if DISTRIBUTED else MAIN_DEVICE
+
+    # SET MODEL
+    model = build_model(experiment, main_device)
+
+    if not os.path.exists(ROOT_DIR):
+        raise Exception('Directory does not exist')
+    work = Trainer(model, ROOT_DIR, PRETRAINED, experiment, main_device=main_device, trackgrad=TRACKGRAD)
+    work.model_version = experiment['model_version']
+    work.train()
+    if DISTRIBUTED:
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    main()
+
+# Usage python3 trainer.py --train/test  (runs the EXPERIMENT of settings.py)
+#       torchrun --nproc_per_node=<N> trainer.py  (with DISTRIBUTED = True)
@@ -0,0 +1,9 @@
+import sys
+
+sys.path.append('..')
+from trainer import main
+
+if __name__ == '__main__':
+    main('uncertainty')
+
+# Usage python3 uncertainty.py --train/test
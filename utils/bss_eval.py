@@ -0,0 +1,104 @@
+"""Framewise BSS-eval (SDR, SIR and SAR) of the sources of a track.
+
+Computes the same decomposition as mir_eval.separation.bss_eval_sources_framewise (time-invariant distortion filters
+of EVAL_FILTER_LENGTH taps, no permutation search) but solves all the windows of a batch at once. The correlations
+between the delayed references and the estimates of every window come from one batched FFT, the Gram matrix of a
+window is factorized once for all its estimated sources instead of once per source, and the projections are
+filtered in the frequency domain.
+"""
+
+import warnings
+import numpy as np
+from settings import *
+
+
+def frame_signals(signals, window, hop):
+    """[n_windows, n_sources, window] view of the windows of signals [n_sources, n_samples]."""
+    n_windows = (signals.shape[1] - window) // hop + 1
+    strides = (signals.strides[1] * hop, signals.strides[0], signals.strides[1])
+    return np.lib.stride_tricks.as_strided(signals, (n_windows, signals.shape[0], window), strides, writeable=False)
+
+
+def safe_db(num, den):
+    """10 log10(num / den), inf where den is 0."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(den == 0, np.inf, 10 * np.log10(num / den))
+
+
+def solve(G, D):
+    """Batched solution of G x = D, falling back to least squares for the windows whose G is singular."""
+    try:
+        return np.linalg.solve(G, D)
+    except np.linalg.LinAlgError:
+        return np.stack([np.linalg.lstsq(g, d, rcond=None)[0] for g, d in zip(G, D)])
+
+
+def bss_eval_windows(references, estimates, flen=EVAL_FILTER_LENGTH):
+    """SDR, SIR and SAR [n_windows, n_sources] of windows [n_windows, n_sources, window_length]."""
+    n_windows, n_src, length = references.shape
+    n_fft = int(2 ** np.ceil(np.log2(length + flen - 1)))
+    ref_f = np.fft.rfft(references, n=n_fft, axis=-1)
+    est_f = np.fft.rfft(estimates, n=n_fft, axis=-1)
+
+    # Correlations at every lag: ref_ref[w, i, j, l] = sum_t ref_i[t + l] ref_j[t], ref_est alike with the estimates
+    ref_ref = np.fft.irfft(ref_f[:, :, None] * ref_f[:, None].conj(), n=n_fft, axis=-1)
+    ref_est = np.fft.irfft(ref_f[:, :, None] * est_f[:, None].conj(), n=n_fft, axis=-1)
+    taps = np.arange(flen)
+    # Gram matrix of the delayed references, [w, i * flen + a, j * flen + b] = ref_ref[w, i, j, b - a]
+    G = ref_ref[..., (taps[None, :] - taps[:, None]) % n_fft].transpose(0, 1, 3, 2, 4)
+    # Inner products of the estimates with the delayed references, [w, i * flen + a, k] = ref_est[w, i, k, -a]
+    D = ref_est[..., -taps % n_fft].transpose(0, 1, 3, 2)
+
+    # Distortion filters of every estimate over all the references, and over its own reference only
+    C = solve(G.reshape(n_windows, n_src * flen, n_src * flen), D.reshape(n_windows, n_src * flen, n_src))
+    C = C.reshape(n_windows, n_src, flen, n_src)
+    diag = np.arange(n_src)
+    C_spat = solve(G[:, diag, :, diag].transpose(1, 0, 2, 3), D[:, diag, :, diag].transpose(1, 0, 2)[..., None])
+
+    # Projections, filtered in the frequency domain (n_fft covers the full linear convolution)
+    size = length + flen - 1
+    C_f = np.fft.rfft(C, n=n_fft, axis=2)
+    proj = np.fft.irfft(np.einsum('wiak,wia->wka', C_f, ref_f), n=n_fft, axis=-1)[..., :size]
+    proj_spat = np.fft.irfft(np.fft.rfft(C_spat[..., 0], n=n_fft, axis=-1) * ref_f, n=n_fft, axis=-1)[..., :size]
+    estimates = np.pad(estimates, ((0, 0), (0, 0), (0, flen - 1)))
+
+    # proj_spat = s_true + e_spat, proj - proj_spat = e_interf and estimates - proj = e_artif
+    energy = lambda x: np.sum(x ** 2, axis=-1)
+    sdr = safe_db(energy(proj_spat), energy(estimates - proj_spat))
+    sir = safe_db(energy(proj_spat), energy(proj - proj_spat))
+    sar = safe_db(energy(proj), energy(estimates - proj))
+    return sdr, sir, sar
+
+
+def bss_eval_framewise(references, estimates, window=EVAL_WINDOW, hop=EVAL_HOP, batch=EVAL_WINDOW_BATCH):
+    """Framewise BSS-eval of a track.
+
+    Args:
+        references, estimates: [n_sources, n_samples] ground truth and estimated sources.
+        window, hop: length of the windows and distance between them in samples. A window of None evaluates the
+            whole track at once, like mir_eval.separation.bss_eval_sources.
+        batch: windows solved at once. Memory grows with (batch * n_sources * EVAL_FILTER_LENGTH) ** 2.
+
+    Returns:
+        [3, n_sources, n_windows] SDR, SIR and SAR of every window, nan in the windows where a source is silent,
+        and their [3, n_sources] medians over the windows.
+    """
+    references = np.asarray(references, dtype=np.float64)
+    estimates = np.asarray(estimates, dtype=np.float64)
+    if window is None or window > references.shape[1]:
+        window = hop = references.shape[1]
+    ref_windows = frame_signals(references, window, hop)
+    est_windows = frame_signals(estimates, window, hop)
+    # As in mir_eval, a source is silent in a window when all of its samples are zero
+    silent = np.any(np.all(ref_windows == 0, axis=-1), axis=1) | np.any(np.all(est_windows == 0, axis=-1), axis=1)
+    active = np.flatnonzero(~silent)
+
+    metrics = np.full((3, len(ref_windows), references.shape[0]), np.nan)
+    for i in range(0, len(active), batch):
+        idx = active[i:i + batch]
+        metrics[:, idx] = bss_eval_windows(ref_windows[idx], est_windows[idx])
+    metrics = metrics.transpose(0, 2, 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # sources silent in every window have a nan median
+        medians = np.nanmedian(metrics, axis=-1)
+    return metrics, medians
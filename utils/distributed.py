@@ -0,0 +1,45 @@
+import torch
+import torch.distributed as dist
+from settings import *
+
+
+def init_distributed():
+    """Joins the process group described by the environment that torchrun sets up (RANK, LOCAL_RANK, WORLD_SIZE,
+    MASTER_ADDR and MASTER_PORT). Returns the device of the process: its local GPU if there is one, else the CPU."""
+    dist.init_process_group(backend=DIST_BACKEND)
+    if torch.cuda.is_available():
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        torch.cuda.set_device(local_rank)
+        return local_rank
+    return 'cpu'
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def barrier():
+    """Waits for all the processes. Does nothing outside distributed mode."""
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+
+
+def all_reduce_sum(values, device='cpu'):
+    """Sums a list of numbers over all the processes."""
+    tensor = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def broadcast_object(obj, src=0):
+    """Picklable object held by the process of rank src."""
+    objects = [obj]
+    dist.broadcast_object_list(objects, src)
+    return objects[0]
+
+
+def broadcast_values(values, device='cpu', src=0):
+    """Values of a list of numbers held by the process of rank src."""
+    tensor = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.broadcast(tensor, src)
+    return tensor.tolist()
@@ -0,0 +1,106 @@
+"""Background writing of the audio and spectrogram dumps.
+
+Encoding the WAVs and rendering the spectrogram PNGs of a batch takes far longer than a training step, so it runs in
+a pool of worker processes fed by a bounded queue. The training loop only reconstructs the waveforms of the batch,
+in one batched iSTFT on the device of the model, copies what it dumps to the CPU and queues one job per sample.
+"""
+
+import queue
+from multiprocessing import get_context
+import librosa
+import torch
+from utils.utils import create_folder, batch_istft_reconstruction, save_spectrogram
+from settings import *
+
+
+def dump_sample(job):
+    """Writes the dumps of a sample: ground truth and estimated WAVs of every target source along with the ground
+    truth, oracle and estimated magnitude spectrograms."""
+    create_folder(job['audio_folder'])
+    create_folder(job['visual_folder'])
+    for n, source in enumerate(job['sources']):
+        for prefix, audio in [('GT_', job['gt_audio'][n]), ('PR_', job['pred_audio'][n])]:
+            librosa.output.write_wav(os.path.join(job['audio_folder'], prefix + source + '.wav'), audio,
+                                     TARGET_SAMPLING_RATE)
+        for suffix, mag in [('_MAG_GT.png', job['gt'][n]), ('_MAG_ORACLE.png', job['oracle'][n]),
+                            ('_MAG_ESTIMATE.png', job['pred'][n])]:
+            save_spectrogram(torch.from_numpy(mag).unsqueeze(0), os.path.join(job['visual_folder'], source), suffix)
+
+
+def dump_worker(jobs):
+    torch.set_num_threads(1)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        try:
+            dump_sample(job)
+        except Exception as e:
+            print('Failed to dump {0}: {1}'.format(job['audio_folder'], e))
+
+
+class DumpService(object):
+    """Pool of DUMP_WORKERS processes writing the dumps queued by submit or dump_batch. The queue holds at most
+    DUMP_QUEUE_SIZE samples: once it is full the training loop drops samples, while blocking callers (the test
+    scripts, which must dump every sample) wait for room instead."""
+
+    def __init__(self, workers=DUMP_WORKERS, queue_size=DUMP_QUEUE_SIZE):
+        # spawn rather than fork: workers must not inherit the CUDA context of the parent
+        context = get_context('spawn')
+        self.jobs = context.Queue(maxsize=queue_size)
+        self.workers = [context.Process(target=dump_worker, args=(self.jobs,), daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        self.submitted = 0
+        self.dropped = 0
+
+    def submit(self, job, block=False):
+        """Queues the dumps of a sample. Returns False if the queue was full and the sample has been dropped."""
+        try:
+            self.jobs.put(job, block=block)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.submitted += 1
+        return True
+
+    def dump_batch(self, text, phase, gt_mags, oracle_spec, pred_spec, targets, audio_folder, visual_folder,
+                   block=False):
+        """Queues the dumps of every sample of a batch.
+
+        Args:
+            text: sample paths, which name the dump folders of the samples.
+            phase: [B, 1, F, T] mixture phase.
+            gt_mags, oracle_spec, pred_spec: [B, C, F, T] linear-frequency magnitudes.
+            targets: (ground truth channel, estimated channel, source name) triplets dumped for every sample, or one
+                list of triplets per sample.
+        """
+        gt_audio = batch_istft_reconstruction(gt_mags.detach().float(), phase, HOP_LENGTH).cpu().numpy()
+        pred_audio = batch_istft_reconstruction(pred_spec.detach().float(), phase, HOP_LENGTH).cpu().numpy()
+        gt_mags = gt_mags.detach().float().cpu().numpy()
+        oracle_spec = oracle_spec.detach().float().cpu().numpy()
+        pred_spec = pred_spec.detach().float().cpu().numpy()
+        for i, sample in enumerate(text):
+            sample_targets = targets[i] if isinstance(targets[0], list) else targets
+            sample_id = os.path.basename(sample)[:-4]
+            folder_name = os.path.basename(os.path.dirname(sample))
+            gt_channels = [j for j, _, _ in sample_targets]
+            pred_channels = [k for _, k, _ in sample_targets]
+            self.submit({'audio_folder': os.path.join(audio_folder, folder_name, sample_id),
+                         'visual_folder': os.path.join(visual_folder, folder_name, sample_id),
+                         'sources': [source for _, _, source in sample_targets],
+                         'gt_audio': gt_audio[i][gt_channels],
+                         'pred_audio': pred_audio[i][pred_channels],
+                         'gt': gt_mags[i][gt_channels],
+                         'oracle': oracle_spec[i][gt_channels],
+                         'pred': pred_spec[i][pred_channels]}, block=block)
+
+    def close(self):
+        """Waits for the queued dumps to be written and stops the workers."""
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        if self.dropped:
+            print('Dumped {0} samples, dropped {1} while the dump workers were busy'.format(self.submitted,
+                                                                                           self.dropped))
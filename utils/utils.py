@@ -227,11 +227,173 @@ def istft_reconstruction(mag, phase, hop_length=256):
     return np.clip(wav, -1., 1.)
 
 
-def linearize_log_freq_scale(nonlinear_vec, grid_unwarp):
+def batch_istft_reconstruction(mag, phase, hop_length=256):
+    """Batched istft_reconstruction: inverts the magnitudes [..., F, T] with the phases [..., F, T] in a single
+    torch.istft call on the device of mag. The phases are broadcast against the magnitudes, so that one mixture phase
+    [B, 1, F, T] serves the K sources [B, K, F, T]. Returns the waveforms [..., hop_length * (T - 1)], which match
+    librosa.istft (hann window, centered frames) up to floating point precision."""
+    phase = phase.to(mag.device, mag.dtype).expand_as(mag)
+    spec = torch.polar(mag, phase)
+    n_fft = 2 * (mag.shape[-2] - 1)
+    wav = torch.istft(spec.reshape(-1, *mag.shape[-2:]),
+                      n_fft=n_fft,
+                      hop_length=hop_length,
+                      window=torch.hann_window(n_fft, device=mag.device, dtype=mag.dtype),
+                      center=True)
+    return wav.reshape(*mag.shape[:-2], -1).clamp(-1., 1.)
+
+
+def interpolation_taps(coords, n_in, align_corners=False):
+    """Linear interpolation that samples an axis of n_in pixels at the normalized coordinates coords, with the
+    conventions of F.grid_sample (bilinear, zero padding). Output i is scale[i] * lerp(x[lower[i]], x[upper[i]],
+    frac[i]); taps falling in the zero padding are folded into scale so that every index stays in range."""
+    if align_corners:
+        pos = (coords + 1) / 2 * (n_in - 1)
+    else:
+        pos = ((coords + 1) * n_in - 1) / 2
+    lower = np.floor(pos).astype(np.int64)
+    frac = pos - lower
+    upper = lower + 1
+    scale = np.ones(len(coords))
+    low_out, up_out = (lower < 0) | (lower >= n_in), (upper < 0) | (upper >= n_in)
+    scale[low_out & ~up_out] = frac[low_out & ~up_out]
+    scale[up_out & ~low_out] = 1 - frac[up_out & ~low_out]
+    scale[low_out & up_out] = 0
+    lower[low_out] = upper[low_out]
+    upper[up_out] = lower[up_out]
+    frac[low_out | up_out] = 0
+    return np.clip(lower, 0, n_in - 1), np.clip(upper, 0, n_in - 1), frac, scale
+
+
+def contiguous_runs(indices):
+    """Splits an index array into (start, stop) slices of consecutive indices."""
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    return [(int(run[0]), int(run[-1]) + 1) for run in np.split(indices, breaks)]
+
+
+class LogFreqWarp(torch.nn.Module):
+    """Log-frequency warp (warp=True) or unwarp (warp=False) of a [B, C, h_in, w] spectrogram.
+
+    The grid of warpgrid is separable and the same for every frame and sample, so the bilinear sampling of
+    F.grid_sample factors into a banded [h_out, h_in] frequency operator and a banded [w, w] time operator, each
+    with two taps per output row. The taps are precomputed once; the frequency operator is applied with row
+    gathers and the time operator, a near-identity shift, with a few contiguous slices. With align_corners=True the
+    time operator is the identity and is skipped; the default False reproduces F.grid_sample as called here (its
+    default since torch 1.3). matrix() returns the dense operators, e.g. to invert them with torch.pinverse.
+    """
+
+    def __init__(self, h_in, h_out, w, warp=True, align_corners=False):
+        super(LogFreqWarp, self).__init__()
+        grid = warpgrid(1, h_out, w, warp=warp)[0]
+        self.align_corners = align_corners
+        self.h_in, self.w = h_in, w
+        self.freq_taps = interpolation_taps(grid[:, 0, 1], h_in, align_corners)
+        self.time_taps = interpolation_taps(grid[0, :, 0], w, align_corners)
+        lower, upper, frac, scale = self.freq_taps
+        self.register_buffer('freq_taps_idx', torch.from_numpy(np.concatenate([lower, upper])))
+        self.register_buffer('freq_frac', torch.from_numpy(frac).float().unsqueeze(-1))
+        self.freq_edges = np.flatnonzero(scale != 1).tolist()
+        self.register_buffer('freq_edge_scale', torch.from_numpy(scale[self.freq_edges]).float().unsqueeze(-1))
+        lower, upper, frac, scale = self.time_taps
+        self.time_lower, self.time_upper = contiguous_runs(lower), contiguous_runs(upper)
+        self.register_buffer('time_frac', torch.from_numpy(frac).float())
+        self.time_edges = np.flatnonzero(scale != 1).tolist()
+        self.register_buffer('time_edge_scale', torch.from_numpy(scale[self.time_edges]).float())
+
+    def matrix(self, axis='freq'):
+        """Dense [out, in] operator along the 'freq' or 'time' axis."""
+        lower, upper, frac, scale = self.freq_taps if axis == 'freq' else self.time_taps
+        dense = np.zeros((len(lower), self.h_in if axis == 'freq' else self.w))
+        rows = np.arange(len(lower))
+        np.add.at(dense, (rows, lower), scale * (1 - frac))
+        np.add.at(dense, (rows, upper), scale * frac)
+        return torch.from_numpy(dense).float()
+
+    def warp_freq(self, x):
+        h_out = self.freq_frac.shape[0]
+        taps = x.index_select(-2, self.freq_taps_idx)
+        y = torch.lerp(taps[..., :h_out, :], taps[..., h_out:, :], self.freq_frac.to(x.dtype))
+        if self.freq_edges:
+            y[..., self.freq_edges, :] *= self.freq_edge_scale.to(x.dtype)
+        return y
+
+    def warp_time(self, x):
+        if self.align_corners:
+            return x
+        lower = torch.cat([x[..., start:stop] for start, stop in self.time_lower], dim=-1)
+        upper = torch.cat([x[..., start:stop] for start, stop in self.time_upper], dim=-1)
+        y = torch.lerp(lower, upper, self.time_frac.to(x.dtype))
+        if self.time_edges:
+            y[..., self.time_edges] *= self.time_edge_scale.to(x.dtype)
+        return y
+
+    def forward(self, x):
+        # Both operators commute, the time one is applied on the side with fewer frequency rows
+        if self.freq_frac.shape[0] <= x.shape[-2]:
+            return self.warp_time(self.warp_freq(x))
+        return self.warp_freq(self.warp_time(x))
+
+
+_GRID_CACHE = {}
+
+
+def cached_warpgrid(bs, h, w, warp, device, dtype=torch.float32):
+    """warpgrid for a batch of bs, kept on the device. The grid is the same for every sample, so a single one is
+    cached per (h, w, warp, device, dtype) and broadcast over the batch instead of being rebuilt for every size."""
+    key = (h, w, warp, str(device), dtype)
+    if key not in _GRID_CACHE:
+        _GRID_CACHE[key] = torch.from_numpy(warpgrid(1, h, w, warp=warp)).to(device=device, dtype=dtype)
+    return _GRID_CACHE[key].expand(bs, -1, -1, -1)
+
+
+_WARP_CACHE = {}
+
+
+def cached_log_freq_warp(h_in, h_out, w, warp, device):
+    key = (h_in, h_out, w, warp, str(device))
+    if key not in _WARP_CACHE:
+        _WARP_CACHE[key] = LogFreqWarp(h_in, h_out, w, warp=warp).to(device)
+    return _WARP_CACHE[key]
+
+
+def warp_log_freq_scale(linear_vec, h=256):
+    if WARP_OPERATOR == 'banded':
+        return cached_log_freq_warp(linear_vec.shape[-2], h, linear_vec.shape[-1], True, linear_vec.device)(linear_vec)
+    return F.grid_sample(linear_vec, cached_warpgrid(linear_vec.shape[0], h, linear_vec.shape[-1], True,
+                                                     linear_vec.device, linear_vec.dtype))
+
+
+def linearize_log_freq_scale(nonlinear_vec, grid_unwarp=None):
+    if grid_unwarp is None:
+        if WARP_OPERATOR == 'banded':
+            return cached_log_freq_warp(nonlinear_vec.shape[-2], NFFT // 2 + 1, nonlinear_vec.shape[-1], False,
+                                        nonlinear_vec.device)(nonlinear_vec)
+        grid_unwarp = cached_warpgrid(nonlinear_vec.shape[0], NFFT // 2 + 1, nonlinear_vec.shape[-1], False,
+                                      nonlinear_vec.device, nonlinear_vec.dtype)
     linear_vec = F.grid_sample(nonlinear_vec, grid_unwarp)
     return linear_vec
 
 
+def device_type(device):
+    return 'cpu' if str(device) == 'cpu' else 'cuda'
+
+
+def autocast(device):
+    """Mixed-precision region for the forward pass and the losses, active when AMP is set. Works with the CPU
+    bfloat16 path as well as on GPU."""
+    return torch.autocast(device_type=device_type(device), dtype=getattr(torch, AMP_DTYPE), enabled=AMP)
+
+
+def full_precision(device):
+    """Region excluded from autocast, for the numerically sensitive parts of the forward pass."""
+    return torch.autocast(device_type=device_type(device), enabled=False)
+
+
+def make_grad_scaler(device):
+    # Loss scaling is only needed for float16; bfloat16 has the exponent range of float32
+    return torch.amp.GradScaler(device_type(device), enabled=AMP and AMP_DTYPE == 'float16')
+
+
 def plot_spectrogram(writer, spectrogram, identifier, iter_val):
     spectrogram_db = amplitude_to_db(spectrogram, ref=torch.max)
     spectrogram_db = rescale(spectrogram_db, min_range=0, max_range=1)